@@ -0,0 +1,49 @@
+import numpy as np
+
+# Zoomed-out summaries of /radius results, for when there are far too many aircraft on screen to send (or draw) one by
+# one. Both are binned in one pass with numpy rather than looping over the records.
+
+
+# Web Mercator position in units of whole tiles at the given zoom, x eastwards and y southwards as map tiles count
+def _mercator(lat, lon, zoom: int):
+    n = float(1 << zoom)
+    lat_rad = np.radians(np.clip(lat, -85.05112878, 85.05112878))
+    x = (lon + 180.0) / 360.0 * n
+    y = (1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n
+    return x, y
+
+
+# Groups aircraft sharing a square of 1/cells_per_tile of a map tile at this zoom, so clusters stay the same size on
+# screen whatever the zoom. Each cluster is its members' centroid, how many there are, and the hex of whichever member
+# sits closest to the centroid (for labelling, or to zoom in on).
+def clusters(records, zoom: int, cells_per_tile: int = 8):
+    if not records:
+        return []
+
+    lat = np.fromiter((r["lat"] for r in records), dtype=np.float64, count=len(records))
+    lon = np.fromiter((r["lon"] for r in records), dtype=np.float64, count=len(records))
+    x, y = _mercator(lat, lon, zoom)
+
+    cells = np.floor(x * cells_per_tile).astype(np.int64) * (cells_per_tile << zoom) + \
+        np.floor(y * cells_per_tile).astype(np.int64)
+    keys, members = np.unique(cells, return_inverse=True)
+
+    count = np.bincount(members)
+    centroid_lat = np.bincount(members, weights=lat) / count
+    centroid_lon = np.bincount(members, weights=lon) / count
+
+    # Nearest member to each centroid: sort by (cluster, distance) and take the first of every cluster
+    distance = (lat - centroid_lat[members]) ** 2 + (lon - centroid_lon[members]) ** 2
+    order = np.lexsort((distance, members))
+    first = order[np.searchsorted(members[order], np.arange(len(keys)))]
+
+    return [{"lat": la, "lon": lo, "count": c, "hex": records[i]["hex"]}
+            for la, lo, c, i in zip(centroid_lat.tolist(), centroid_lon.tolist(), count.tolist(), first.tolist())]
+
+
+# Aircraft counts over a fixed rows x cols grid laid evenly over the bbox (in degrees), row 0 along the southern edge
+def density_grid(records, sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float, rows: int, cols: int):
+    lat = np.fromiter((r["lat"] for r in records), dtype=np.float64, count=len(records))
+    lon = np.fromiter((r["lon"] for r in records), dtype=np.float64, count=len(records))
+    counts, _, _ = np.histogram2d(lat, lon, bins=(rows, cols), range=((sw_lat, ne_lat), (sw_lon, ne_lon)))
+    return counts.astype(np.int64)
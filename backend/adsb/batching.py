@@ -0,0 +1,90 @@
+import asyncio
+
+
+# Collects hex lookups from concurrent requests for a short window and sends them upstream together, since the hex
+# endpoint takes a comma-separated list. Each caller gets back just the aircraft it asked for, or the exception that
+# its chunk failed with.
+class HexBatcher:
+    def __init__(self, fetch, window: float = 0.05, max_hexes: int = 100, max_url_length: int = 2000,
+                 base_url_length: int = 40):
+        self.fetch_chunk = fetch
+        self.window = window
+        self.max_hexes = max_hexes
+        self.max_url_length = max_url_length
+        self.base_url_length = base_url_length
+        self.pending = {}     # hex -> future, waiting for the window to close
+        self.in_flight = {}   # hex -> future, already sent upstream
+        self.flush_handle = None
+        self.tasks = set()    # running chunks, held here so they aren't garbage collected mid-fetch
+        self.batches = 0
+
+    def clear(self):
+        self.pending.clear()
+        self.in_flight.clear()
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        for task in self.tasks:
+            task.cancel()
+
+    # Split by count and by how long the comma-separated URL would get
+    def chunks(self, hex_list):
+        chunk, length = [], self.base_url_length
+        for hex_code in hex_list:
+            if chunk and (len(chunk) >= self.max_hexes or length + len(hex_code) + 1 > self.max_url_length):
+                yield chunk
+                chunk, length = [], self.base_url_length
+            chunk.append(hex_code)
+            length += len(hex_code) + 1
+        if chunk:
+            yield chunk
+
+    async def fetch(self, hex_list):
+        loop = asyncio.get_event_loop()
+        futures = {}
+
+        for hex_code in dict.fromkeys(hex_list):
+            future = self.pending.get(hex_code) or self.in_flight.get(hex_code)
+            if future is None:
+                future = self.pending[hex_code] = loop.create_future()
+            futures[hex_code] = future
+
+        if self.pending and self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.window, self._flush)
+
+        # Futures are shared with other callers, so a client going away mustn't cancel them for everyone else
+        results = await asyncio.gather(*(asyncio.shield(future) for future in futures.values()))
+        return {hex_code: record for hex_code, record in zip(futures, results) if record is not None}
+
+    def _flush(self):
+        self.flush_handle = None
+        batch, self.pending = self.pending, {}
+        self.in_flight.update(batch)
+
+        for chunk in self.chunks(list(batch)):
+            self.batches += 1
+            task = asyncio.create_task(self._run(chunk, {hex_code: batch[hex_code] for hex_code in chunk}))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, chunk, futures):
+        try:
+            records = await self.fetch_chunk(chunk)
+        except Exception as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+        except BaseException:
+            # Cancelled (e.g. on shutdown), so don't leave anyone waiting on an answer that isn't coming
+            for future in futures.values():
+                if not future.done():
+                    future.cancel()
+            raise
+        else:
+            for hex_code, future in futures.items():
+                if not future.done():
+                    future.set_result(records.get(hex_code))
+        finally:
+            for hex_code, future in futures.items():
+                if self.in_flight.get(hex_code) is future:
+                    del self.in_flight[hex_code]
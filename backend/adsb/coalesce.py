@@ -0,0 +1,85 @@
+import asyncio
+
+from haversine import haversine, Unit
+
+
+class _Query:
+    def __init__(self, lat: float, lon: float, radius: float, task: asyncio.Task):
+        self.lat = lat
+        self.lon = lon
+        self.radius = radius
+        self.task = task
+        self.finished_at = None
+
+    # A circle covers another if the furthest edge of the smaller one still falls inside it
+    def covers(self, lat: float, lon: float, radius: float):
+        distance = haversine((self.lat, self.lon), (lat, lon), unit=Unit.NAUTICAL_MILES)
+        return distance + radius <= self.radius
+
+
+def _position(aircraft):
+    if "lat" in aircraft and "lon" in aircraft:
+        return aircraft["lat"], aircraft["lon"]
+    last = aircraft.get("lastPosition") or {}
+    if "lat" in last and "lon" in last:
+        return last["lat"], last["lon"]
+    return None
+
+
+# Single-flight for upstream point queries: a request whose circle sits inside one that is already in-flight (or only
+# just finished) waits on that result instead of taking another upstream rate limit slot.
+class RadiusCoalescer:
+    def __init__(self, window: float = 2.0):
+        self.window = window
+        self.queries = []
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.queries = []
+
+    def _prune(self, now: float):
+        self.queries = [q for q in self.queries if q.finished_at is None or now - q.finished_at <= self.window]
+
+    def _finished(self, query: _Query, task: asyncio.Task):
+        if task.cancelled() or task.exception() is not None:
+            # Never reuse failures, the next request should get its own attempt
+            if query in self.queries:
+                self.queries.remove(query)
+        else:
+            query.finished_at = asyncio.get_event_loop().time()
+
+    async def fetch(self, lat: float, lon: float, radius: float, fetcher):
+        now = asyncio.get_event_loop().time()
+        self._prune(now)
+
+        for query in self.queries:
+            if query.covers(lat, lon, radius):
+                self.hits += 1
+                content = await asyncio.shield(query.task)
+                if query.lat == lat and query.lon == lon and query.radius == radius:
+                    return content
+                return self._subset(content, lat, lon, radius)
+
+        self.misses += 1
+
+        # Run as a separate task so a disconnecting client doesn't cancel the fetch for everybody else waiting on it
+        task = asyncio.create_task(fetcher(lat, lon, radius))
+        query = _Query(lat, lon, radius, task)
+        self.queries.append(query)
+        task.add_done_callback(lambda t: self._finished(query, t))
+
+        return await asyncio.shield(task)
+
+    # Trim a larger upstream result back down to what the smaller circle would have returned on its own
+    @staticmethod
+    def _subset(content, lat: float, lon: float, radius: float):
+        subset = []
+        for aircraft in content.get("ac", []):
+            position = _position(aircraft)
+            if position is None:
+                # Leave for the caller to deal with, same as with a direct upstream response
+                subset.append(aircraft)
+            elif haversine((lat, lon), position, unit=Unit.NAUTICAL_MILES) <= radius:
+                subset.append(aircraft)
+        return {**content, "ac": subset}
@@ -0,0 +1,153 @@
+import json
+import math
+import struct
+from array import array
+
+# Compact columnar encoding of a list of aircraft records, served instead of JSON when the client sends
+# Accept: application/x-adsb-columnar. Key names are written once, numbers as packed typed arrays, and every string
+# (hex, flight, registration...) once in a shared string table.
+#
+# Layout, all little-endian:
+#
+#   magic     4 bytes   b"ACOL"
+#   version   uint8     1
+#   columns   uint8     number of columns
+#   rows      uint32    number of records
+#   strings   uint32    number of entries in the string table
+#   then for each column:
+#     name    uint8 length + UTF-8 bytes
+#     type    1 ASCII byte, one of
+#               d  float64 array, NaN where a record had no value
+#               f  float32 array, NaN where a record had no value
+#               s  uint32 string table index array, 0xFFFFFFFF where a record had no value
+#               j  as s, but the string is a JSON value (columns mixing types, e.g. alt_baro's "ground")
+#   then the string table: per entry a uint16 length + UTF-8 bytes
+#   then each column's array (rows elements) in column order
+#
+# Numbers always come back as floats. Use decode() below, or mirror it in the frontend with a DataView.
+
+MEDIA_TYPE = "application/x-adsb-columnar"
+MAGIC = b"ACOL"
+VERSION = 1
+NULL_INDEX = 0xFFFFFFFF
+
+# Track doesn't need double precision, positions do
+FLOAT32_COLUMNS = {"track"}
+
+
+def accepts_columnar(accept_header) -> bool:
+    return accept_header is not None and MEDIA_TYPE in accept_header
+
+
+def _column_type(name, values):
+    present = [v for v in values if v is not None]
+    if all(isinstance(v, str) for v in present):
+        return "s"
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+        return "f" if name in FLOAT32_COLUMNS else "d"
+    return "j"
+
+
+def encode(records, columns) -> bytes:
+    strings = {}
+
+    def intern(value):
+        index = strings.get(value)
+        if index is None:
+            index = strings[value] = len(strings)
+        return index
+
+    header = []
+    arrays = []
+    for name in columns:
+        values = [record.get(name) for record in records]
+        kind = _column_type(name, values)
+
+        if kind in "df":
+            arrays.append(array(kind, [math.nan if v is None else v for v in values]))
+        elif kind == "s":
+            arrays.append(array("I", [NULL_INDEX if v is None else intern(v) for v in values]))
+        else:
+            arrays.append(array("I", [NULL_INDEX if v is None else intern(json.dumps(v)) for v in values]))
+
+        encoded_name = name.encode()
+        header.append(struct.pack("<B", len(encoded_name)) + encoded_name + kind.encode())
+
+    parts = [MAGIC, struct.pack("<BBII", VERSION, len(columns), len(records), len(strings))]
+    parts.extend(header)
+    for value in strings:
+        encoded = value.encode()
+        parts.append(struct.pack("<H", len(encoded)) + encoded)
+    parts.extend(a.tobytes() for a in arrays)
+    return b"".join(parts)
+
+
+# Reference decoder, returns the list of records (dicts) that was encoded
+def decode(data: bytes):
+    if data[:4] != MAGIC:
+        raise ValueError("Not a columnar aircraft payload")
+
+    version, column_count, rows, string_count = struct.unpack_from("<BBII", data, 4)
+    if version != VERSION:
+        raise ValueError(f"Unsupported columnar version {version}")
+    offset = 4 + struct.calcsize("<BBII")
+
+    columns = []
+    for _ in range(column_count):
+        (length,) = struct.unpack_from("<B", data, offset)
+        name = data[offset + 1:offset + 1 + length].decode()
+        kind = chr(data[offset + 1 + length])
+        columns.append((name, kind))
+        offset += length + 2
+
+    strings = []
+    for _ in range(string_count):
+        (length,) = struct.unpack_from("<H", data, offset)
+        strings.append(data[offset + 2:offset + 2 + length].decode())
+        offset += length + 2
+
+    records = [{} for _ in range(rows)]
+    for name, kind in columns:
+        typecode = kind if kind in "df" else "I"
+        values = array(typecode)
+        size = values.itemsize * rows
+        values.frombytes(data[offset:offset + size])
+        offset += size
+
+        for record, value in zip(records, values):
+            if kind in "df":
+                record[name] = None if math.isnan(value) else value
+            elif value == NULL_INDEX:
+                record[name] = None
+            else:
+                record[name] = strings[value] if kind == "s" else json.loads(strings[value])
+
+    return records
+
+
+if __name__ == "__main__":
+    # Benchmark against the JSON path over a busy-airspace sized response
+    import random
+    import timeit
+
+    random.seed(0)
+    aircraft = [{
+        "hex": f"{random.randrange(1 << 24):06x}",
+        "lat": random.uniform(50.0, 53.0),
+        "lon": random.uniform(-2.0, 1.0),
+        "track": round(random.uniform(0, 360), 2),
+        "flight": random.choice(["N/A", f"BAW{random.randrange(1000):03d} "]),
+    } for _ in range(2000)]
+    columns = ["hex", "lat", "lon", "track", "flight"]
+
+    json_bytes = json.dumps({"ac": aircraft}).encode()
+    columnar_bytes = encode(aircraft, columns)
+    assert decode(columnar_bytes)[0]["hex"] == aircraft[0]["hex"]
+
+    runs = 200
+    json_time = timeit.timeit(lambda: json.dumps({"ac": aircraft}).encode(), number=runs) / runs
+    columnar_time = timeit.timeit(lambda: encode(aircraft, columns), number=runs) / runs
+
+    print(f"{len(aircraft)} aircraft")
+    print(f"json      {len(json_bytes):>8} bytes  {json_time * 1000:.2f} ms")
+    print(f"columnar  {len(columnar_bytes):>8} bytes  {columnar_time * 1000:.2f} ms")
@@ -0,0 +1,45 @@
+import secrets
+import itertools
+import threading
+
+from cachetools import LRUCache
+
+
+# Remembers recent /radius results by version number so a client can be sent just what changed since the last one it
+# saw. Snapshots only hold references to the index's records, so keeping a few hundred around is cheap.
+# Every process numbers its versions under its own random prefix (kept within 2^53, so they survive being a JS number),
+# so a version issued by another worker is just unknown here and gets a full resync rather than a diff against an
+# unrelated snapshot.
+class SnapshotStore:
+    def __init__(self, maxsize: int = 512):
+        self.snapshots = LRUCache(maxsize=maxsize)
+        self.prefix = secrets.randbits(20) << 32
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.snapshots.clear()
+
+    # Version 0 (or one we've since forgotten) gets a full resync
+    def diff(self, records, since: int):
+        current = {record["hex"]: record for record in records}
+
+        with self.lock:
+            previous = self.snapshots.get(since) if since else None
+            version = self.prefix | (next(self.counter) % 0xFFFFFFFF + 1)
+            self.snapshots[version] = current
+
+        if previous is None:
+            return {"version": version, "full": True, "ac": records}
+
+        added, moved = [], []
+        for hex_code, record in current.items():
+            old = previous.get(hex_code)
+            if old is None:
+                added.append(record)
+            elif old != record:
+                moved.append(record)
+
+        removed = [hex_code for hex_code in previous if hex_code not in current]
+        return {"version": version, "full": False, "added": added, "moved": moved, "removed": removed}
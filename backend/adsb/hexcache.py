@@ -0,0 +1,106 @@
+import time
+import threading
+
+from cachetools import LRUCache
+
+# Registry data that barely ever changes for an airframe, everything else is treated as live
+STATIC_FIELDS = {"r", "t", "desc", "dbFlags"}
+
+
+# LRU of upstream aircraft records that remembers when the static and live halves of each record were last ingested,
+# so a lookup can tell whether the fields a caller actually wants are still fresh.
+class HexCache:
+    def __init__(self, maxsize: int = 16000, static_ttl: float = 86400.0, live_ttl: float = 10.0):
+        self.static_ttl = static_ttl
+        self.live_ttl = live_ttl
+        self.entries = LRUCache(maxsize=maxsize)  # hex -> (record, static_at, live_at)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, hex_code):
+        return hex_code in self.entries
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # Whole upstream response in one go, under one lock. Returns the merged records in the same order.
+    def ingest(self, aircraft_list, now=None):
+        now = time.time() if now is None else now
+        merged = []
+
+        with self.lock:
+            for aircraft in aircraft_list:
+                hex_code = aircraft.get("hex")
+                if not hex_code:
+                    continue
+
+                previous = self.entries.get(hex_code)
+                if previous is None:
+                    record, static_at = dict(aircraft), now
+                else:
+                    # Live fields are replaced wholesale, static ones carried over if this response didn't have them
+                    old_record, static_at, _ = previous
+                    record = {key: old_record[key] for key in STATIC_FIELDS if key in old_record}
+                    record.update(aircraft)
+                    if any(key in aircraft for key in STATIC_FIELDS):
+                        static_at = now
+
+                self.entries[hex_code] = (record, static_at, now)
+                merged.append(record)
+
+        return merged
+
+    def is_fresh(self, entry, fields, now: float):
+        _, static_at, live_at = entry
+        for field in fields:
+            age = now - (static_at if field in STATIC_FIELDS else live_at)
+            if age > (self.static_ttl if field in STATIC_FIELDS else self.live_ttl):
+                return False
+        return True
+
+    # Splits the hexes into records that are fresh for the requested fields and ones that need going upstream for
+    def lookup(self, hex_list, fields, now=None):
+        now = time.time() if now is None else now
+        fresh, stale = {}, []
+
+        with self.lock:
+            for hex_code in hex_list:
+                entry = self.entries.get(hex_code)
+                if entry is not None and self.is_fresh(entry, fields, now):
+                    fresh[hex_code] = entry[0]
+                else:
+                    stale.append(hex_code)
+
+        return fresh, stale
+
+    # Raw (record, static_at, live_at) entries, for sharing with other workers
+    def entries_for(self, hex_list):
+        with self.lock:
+            return {h: self.entries[h] for h in hex_list if h in self.entries}
+
+    # Entries from elsewhere (see shared.RedisHexStore), only taken if they're newer than what we have
+    def load(self, entries):
+        with self.lock:
+            for hex_code, (record, static_at, live_at) in entries.items():
+                current = self.entries.get(hex_code)
+                if current is None or live_at > current[2]:
+                    self.entries[hex_code] = (record, static_at, live_at)
+
+    # What we have that's still within its ttl, for when upstream no longer knows about an aircraft. Live fields that
+    # have gone stale are left out rather than passed off as current, and None if nothing but the hex is left.
+    def peek(self, hex_code, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.entries.get(hex_code)
+        if entry is None:
+            return None
+
+        record, static_at, live_at = entry
+        static_fresh = now - static_at <= self.static_ttl
+        live_fresh = now - live_at <= self.live_ttl
+        kept = {key: value for key, value in record.items()
+                if key == "hex" or (static_fresh if key in STATIC_FIELDS else live_fresh)}
+        return kept if len(kept) > 1 else None
@@ -0,0 +1,211 @@
+import io
+import os
+import math
+import time
+import shutil
+import threading
+
+import numpy as np
+from cachetools import LRUCache
+
+# Every aircraft position that comes through the service, kept on disk for playback. Rows are buffered in memory and
+# flushed as compressed numpy chunks, one directory per time partition (named after its start, unix seconds):
+#   history/1718000000/1718000123456-4242-7.npz
+# (flush time in ms, writer's pid, writer's flush count, so workers sharing the directory never pick the same name)
+# Each chunk holds one array per column with rows sorted by latitude, plus "bounds" (min/max of time, lat and lon), so
+# a query skips whole partitions by name, whole chunks by their bounds, and within a chunk only reads the latitude band
+# it needs.
+
+COLUMNS = {
+    "hex": "U8",
+    "flight": "U8",
+    "lat": np.float64,
+    "lon": np.float64,
+    "alt": np.float32,
+    "track": np.float32,
+    "gs": np.float32,
+    "position_time": np.float64,
+}
+
+# Fastest anything we track plausibly moves, knots, for how far outside a bbox to look for aircraft that ended up in it
+MAX_SPEED_KT = 700.0
+
+
+def _empty():
+    return {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+def _concat(chunks):
+    if not chunks:
+        return _empty()
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in COLUMNS}
+
+
+def _take(columns, selection):
+    return {name: values[selection] for name, values in columns.items()}
+
+
+class HistoryStore:
+    def __init__(self, directory: str, partition_seconds: int = 3600, flush_rows: int = 5000,
+                 flush_interval: float = 30.0, retention: float = 7 * 86400, lookback: float = 60.0):
+        self.directory = directory
+        self.partition_seconds = partition_seconds
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.lookback = lookback
+        self.buffer = []
+        self.buffered = 0
+        self.sequence = 0
+        self.last_flush = time.time()
+        self.last_seen = LRUCache(maxsize=100000)  # hex -> newest position time stored
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    # Columns as produced by normalize.normalise_columns. Positions we've already stored are skipped, as the same fix
+    # turns up in every poll until the aircraft reports again.
+    def append(self, columns, now=None):
+        now = time.time() if now is None else now
+        hexes = columns["hex"]
+        if not len(hexes):
+            return
+
+        with self.lock:
+            previous = np.array([self.last_seen.get(h, -math.inf) for h in hexes.tolist()], dtype=np.float64)
+            newer = columns["position_time"] > previous
+            if newer.any():
+                rows = {name: np.asarray(columns[name][newer]).astype(dtype) for name, dtype in COLUMNS.items()}
+                for hex_code, position_time in zip(rows["hex"].tolist(), rows["position_time"].tolist()):
+                    self.last_seen[hex_code] = position_time
+                self.buffer.append(rows)
+                self.buffered += len(rows["hex"])
+
+            if self.buffered >= self.flush_rows or now - self.last_flush >= self.flush_interval:
+                self._flush(now)
+
+    def _flush(self, now: float):
+        self.last_flush = now
+        if not self.buffer:
+            return
+
+        rows = _concat(self.buffer)
+        self.buffer, self.buffered = [], 0
+
+        partitions = (rows["position_time"] // self.partition_seconds * self.partition_seconds).astype(np.int64)
+        for partition in np.unique(partitions).tolist():
+            chunk = _take(rows, partitions == partition)
+            chunk = _take(chunk, np.argsort(chunk["lat"], kind="stable"))
+            bounds = np.array([chunk["position_time"].min(), chunk["position_time"].max(), chunk["lat"][0],
+                               chunk["lat"][-1], chunk["lon"].min(), chunk["lon"].max()])
+
+            directory = os.path.join(self.directory, str(partition))
+            os.makedirs(directory, exist_ok=True)
+            self.sequence += 1
+            path = os.path.join(directory, f"{int(now * 1000)}-{os.getpid()}-{self.sequence}.npz")
+
+            # Written aside and renamed, so readers never see half a chunk
+            data = io.BytesIO()
+            np.savez_compressed(data, bounds=bounds, **chunk)
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(data.getvalue())
+            os.replace(f"{path}.tmp", path)
+
+        self._expire(now)
+
+    def _partitions(self):
+        for name in os.listdir(self.directory):
+            if name.isdigit():
+                yield int(name)
+
+    def _expire(self, now: float):
+        for partition in self._partitions():
+            if partition + self.partition_seconds < now - self.retention:
+                shutil.rmtree(os.path.join(self.directory, str(partition)), ignore_errors=True)
+
+    def flush(self, now=None):
+        with self.lock:
+            self._flush(time.time() if now is None else now)
+
+    def close(self):
+        self.flush()
+
+    def clear(self):
+        with self.lock:
+            self.buffer, self.buffered = [], 0
+            self.last_seen.clear()
+            for partition in list(self._partitions()):
+                shutil.rmtree(os.path.join(self.directory, str(partition)), ignore_errors=True)
+
+    @staticmethod
+    def _filter(columns, sw_lat, sw_lon, ne_lat, ne_lon, start, end):
+        lat, lon, position_time = columns["lat"], columns["lon"], columns["position_time"]
+        mask = (lat >= sw_lat) & (lat <= ne_lat) & (lon >= sw_lon) & (lon <= ne_lon) & \
+            (position_time >= start) & (position_time <= end)
+        return _take(columns, mask)
+
+    def _read(self, path, sw_lat, sw_lon, ne_lat, ne_lon, start, end):
+        try:
+            with np.load(path) as data:
+                t_min, t_max, lat_min, lat_max, lon_min, lon_max = data["bounds"].tolist()
+                if t_max < start or t_min > end or lat_max < sw_lat or lat_min > ne_lat or \
+                        lon_max < sw_lon or lon_min > ne_lon:
+                    return None
+
+                # Sorted by latitude, so the band we want is one contiguous slice
+                lat = data["lat"]
+                low, high = np.searchsorted(lat, sw_lat, side="left"), np.searchsorted(lat, ne_lat, side="right")
+                if low == high:
+                    return None
+                chunk = {name: data[name][low:high] for name in COLUMNS}
+        except (OSError, ValueError, KeyError) as e:
+            print(f"WARNING: Skipping unreadable history chunk {path}: {e}")
+            return None
+        return self._filter(chunk, sw_lat, sw_lon, ne_lat, ne_lon, start, end)
+
+    # Every stored position in the box between start and end (unix seconds), oldest first
+    def between(self, sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float, start: float, end: float):
+        with self.lock:
+            pending = list(self.buffer)
+
+        found = []
+        for partition in sorted(self._partitions()):
+            if partition > end or partition + self.partition_seconds <= start:
+                continue
+            directory = os.path.join(self.directory, str(partition))
+            try:
+                names = sorted(os.listdir(directory))
+            except FileNotFoundError:
+                continue  # expired while we were looking
+            for name in names:
+                if name.endswith(".npz"):
+                    chunk = self._read(os.path.join(directory, name), sw_lat, sw_lon, ne_lat, ne_lon, start, end)
+                    if chunk is not None and len(chunk["hex"]):
+                        found.append(chunk)
+
+        found.extend(self._filter(chunk, sw_lat, sw_lon, ne_lat, ne_lon, start, end) for chunk in pending)
+        columns = _concat(found)
+        return _take(columns, np.argsort(columns["position_time"], kind="stable"))
+
+    # Where everything in the box was at time `at`: each aircraft's last position in the lookback before it. Aircraft
+    # are searched for a little outside the box too, so one that has since flown out of it isn't shown where it was.
+    def at(self, sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float, at: float):
+        margin = self.lookback / 3600 * MAX_SPEED_KT / 60
+        lon_margin = margin / max(math.cos(math.radians(min(max(abs(sw_lat), abs(ne_lat)) + margin, 89.0))), 0.01)
+        columns = self.between(sw_lat - margin, sw_lon - lon_margin, ne_lat + margin, ne_lon + lon_margin,
+                               at - self.lookback, at)
+
+        # Latest row per hex: they're in time order, so the first occurrence of each hex in the reversed columns
+        hexes = columns["hex"][::-1]
+        _, first = np.unique(hexes, return_index=True)
+        latest = _take(columns, len(hexes) - 1 - first)
+
+        lat, lon = latest["lat"], latest["lon"]
+        inside = (lat >= sw_lat) & (lat <= ne_lat) & (lon >= sw_lon) & (lon <= ne_lon)
+        return _take(latest, inside)
+
+
+def records(columns):
+    names = list(COLUMNS)
+    values = [columns[name].tolist() for name in names]
+    return [{name: (None if isinstance(v, float) and math.isnan(v) else v) for name, v in zip(names, row)}
+            for row in zip(*values)]
@@ -0,0 +1,23 @@
+import numpy as np
+
+EARTH_RADIUS_NM = 6371.0088 / 1.852
+
+
+# Dead-reckons a whole batch of aircraft forward to time `at` along their great-circle track at constant ground speed.
+# Aircraft without a ground speed stay put, and nothing is projected more than `horizon` seconds, as beyond that the
+# guess (turns, climbs, landing) is worse than showing the last known position.
+def extrapolate(lat, lon, track, gs, position_time, at: float, horizon: float = 60.0):
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    bearing = np.radians(np.asarray(track, dtype=np.float64))
+
+    elapsed = np.clip(at - np.asarray(position_time, dtype=np.float64), 0.0, horizon)
+    distance = np.nan_to_num(np.asarray(gs, dtype=np.float64)) * elapsed / 3600.0 / EARTH_RADIUS_NM
+
+    new_lat = np.arcsin(np.sin(lat) * np.cos(distance) + np.cos(lat) * np.sin(distance) * np.cos(bearing))
+    new_lon = lon + np.arctan2(np.sin(bearing) * np.sin(distance) * np.cos(lat),
+                               np.cos(distance) - np.sin(lat) * np.sin(new_lat))
+
+    # Wrap back into [-180, 180)
+    new_lon = (new_lon + np.pi) % (2 * np.pi) - np.pi
+    return np.degrees(new_lat), np.degrees(new_lon)
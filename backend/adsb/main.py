@@ -1,138 +1,466 @@
+import os
 import json
 import asyncio
-import threading
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
 
-import requests
-
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, Header, HTTPException
 from fastapi.responses import Response
 
-from haversine import haversine, Unit
+from coalesce import RadiusCoalescer
+from spatial import SpatialIndex
+from planner import QueryPlanner, MAX_RADIUS_NM
+from poller import DemandPoller
+from upstream import UpstreamClient
+from hexcache import HexCache, STATIC_FIELDS
+from registry import AircraftRegistry
+from history import HistoryStore, records as history_records
+from thumbnails import ThumbnailCache, ThumbnailPrefetcher, MISSING
+from delta import SnapshotStore
+from normalize import normalise_columns, records_from_columns
+from trails import TrailStore
+from batching import HexBatcher
+from shared import RedisHexStore, RedisTokenBucket
+from recording import Recorder, Replayer
+from kinematics import extrapolate
+from viewport import quantize_bbox, grid_zoom
+from aggregate import clusters, density_grid
+import columnar
+
+# How long a finished upstream point query can be reused for requests inside its circle
+COALESCE_WINDOW = float(os.getenv("ADSB_COALESCE_WINDOW", "2.0"))
+
+# Grid cell size in degrees, how old a cell's data can be before going back upstream, when to forget an aircraft (or
+# a cell's coverage), and how often to sweep out everything that has been forgotten
+INDEX_CELL_SIZE = float(os.getenv("ADSB_INDEX_CELL_SIZE", "0.1"))
+INDEX_MAX_AGE = float(os.getenv("ADSB_INDEX_MAX_AGE", "3.0"))
+INDEX_EXPIRY = float(os.getenv("ADSB_INDEX_EXPIRY", "60.0"))
+INDEX_SWEEP_INTERVAL = float(os.getenv("ADSB_INDEX_SWEEP_INTERVAL", "30.0"))
+
+# With the poller running, handlers serve anything it has refreshed within this long and only fetch cold regions
+POLLER_ENABLED = os.getenv("ADSB_POLLER_ENABLED", "true").lower() == "true"
+POLLER_MAX_AGE = float(os.getenv("ADSB_POLLER_MAX_AGE", "30.0"))
+
+# Shortest gap between the poller's refreshes of a region too big for upstream to cover in one go
+POLLER_CLAMPED_MIN_AGE = float(os.getenv("ADSB_POLLER_CLAMPED_MIN_AGE", "30.0"))
+
+# If a /radius request would queue longer than this (seconds) for upstream, serve the last data covering it instead
+# and refresh in the background
+WAIT_BUDGET = float(os.getenv("ADSB_WAIT_BUDGET", "2.0"))
+
+# Viewports are snapped outwards onto the tile grid (see viewport.py) before touching the index or upstream, no finer
+# than this zoom, so small pans and zooms reuse the same cells and upstream circles
+VIEWPORT_MAX_ZOOM = int(os.getenv("ADSB_VIEWPORT_MAX_ZOOM", "11"))
+
+# Registry fields (r, t, desc, dbFlags) are kept for a day, anything kinematic only for a few seconds
+HEX_STATIC_TTL = float(os.getenv("ADSB_HEX_STATIC_TTL", "86400"))
+HEX_LIVE_TTL = float(os.getenv("ADSB_HEX_LIVE_TTL", "10.0"))
+
+# Furthest ahead (seconds) /radius?at= will dead-reckon an aircraft from its last position
+EXTRAPOLATE_HORIZON = float(os.getenv("ADSB_EXTRAPOLATE_HORIZON", "60.0"))
+
+# Per-aircraft position history: how many airframes to track at once and how many points to keep for each
+TRAIL_MAX_AIRCRAFT = int(os.getenv("ADSB_TRAIL_MAX_AIRCRAFT", "20000"))
+TRAIL_POINTS = int(os.getenv("ADSB_TRAIL_POINTS", "64"))
+
+# Fields /radius returns per aircraft
+RADIUS_FIELDS = ["hex", "lat", "lon", "track", "flight"]
+
+# How long a /hex cache miss waits for others to share its upstream call
+HEX_BATCH_WINDOW = float(os.getenv("ADSB_HEX_BATCH_WINDOW", "0.05"))
+
+# Fields /hex returns unless asked for a subset
+HEX_FIELDS = ["r", "t", "dbFlags", "gs", "ias", "tas", "desc", "alt_baro", "alt_geom", "seen"]
+
+# Set to share the hex cache and upstream rate limits through Redis, needed once adsb runs as several workers/replicas
+REDIS_URL = os.getenv("ADSB_REDIS_URL")
+
+# Anything the service keeps across restarts lives here, mount a volume over it in production
+DATA_DIR = os.getenv("ADSB_DATA_DIR", ".")
+
+# live (default), record (live, and write every upstream response to the recording) or replay (serve the recording
+# back with no network, at ADSB_REPLAY_SPEED times real time)
+UPSTREAM_MODE = os.getenv("ADSB_UPSTREAM_MODE", "live").lower()
+RECORDING_PATH = os.getenv("ADSB_RECORDING", os.path.join(DATA_DIR, "recording.jsonl.gz"))
+REPLAY_SPEED = float(os.getenv("ADSB_REPLAY_SPEED", "1.0"))
+
+THUMBNAIL_MAX_ENTRIES = int(os.getenv("ADSB_THUMBNAIL_MAX_ENTRIES", "100000"))
+THUMBNAIL_PREFETCH = os.getenv("ADSB_THUMBNAIL_PREFETCH", "true").lower() == "true"
+# Background thumbnail fetches per second, and the most aircraft a /radius response can hold for us to bother
+# prefetching its thumbnails (anything bigger is a zoomed out view nobody is about to click through)
+THUMBNAIL_PREFETCH_RATE = float(os.getenv("ADSB_THUMBNAIL_PREFETCH_RATE", "0.2"))
+THUMBNAIL_PREFETCH_MAX_AIRCRAFT = int(os.getenv("ADSB_THUMBNAIL_PREFETCH_MAX_AIRCRAFT", "50"))
+
+# Static registry data for /hex, built offline with registry.py. Without it static fields come from upstream as before.
+REGISTRY_PATH = os.getenv("ADSB_REGISTRY_PATH", os.path.join(DATA_DIR, "registry.bin"))
+
+# On-disk position history for /history: partition length (seconds), how long to keep it (days) and how long (seconds)
+# an aircraft's last position still counts as where it is
+HISTORY_ENABLED = os.getenv("ADSB_HISTORY_ENABLED", "true").lower() == "true"
+HISTORY_PARTITION = int(os.getenv("ADSB_HISTORY_PARTITION", "3600"))
+HISTORY_RETENTION_DAYS = float(os.getenv("ADSB_HISTORY_RETENTION_DAYS", "7"))
+HISTORY_LOOKBACK = float(os.getenv("ADSB_HISTORY_LOOKBACK", "60"))
+HISTORY_FIELDS = ["hex", "flight", "lat", "lon", "alt", "track", "gs", "position_time"]
+
+# Below this zoom /radius sends clusters (or a density grid, if that's the default or asked for) instead of every
+# aircraft, but only to callers that pass zoom or aggregate, everyone else always gets the plain ac list. Clusters are
+# 1/ADSB_CLUSTER_CELLS of a map tile across.
+POINTS_MIN_ZOOM = int(os.getenv("ADSB_POINTS_MIN_ZOOM", "5"))
+AGGREGATE_DEFAULT = os.getenv("ADSB_AGGREGATE_DEFAULT", "clusters").lower()
+CLUSTER_CELLS = int(os.getenv("ADSB_CLUSTER_CELLS", "8"))
+
+# Query planner: how many aircraft of payload one extra upstream call is worth, the most circles a bbox is split into,
+# and the density (aircraft per square nm) assumed for areas we haven't seen yet
+PLANNER_SLOT_COST = float(os.getenv("ADSB_PLANNER_SLOT_COST", "100"))
+PLANNER_MAX_CIRCLES = int(os.getenv("ADSB_PLANNER_MAX_CIRCLES", "6"))
+PLANNER_DEFAULT_DENSITY = float(os.getenv("ADSB_PLANNER_DEFAULT_DENSITY", "0.002"))
+
+# Requests per second allowed to each upstream host, anything not listed gets the conservative default of 1
+UPSTREAM_RATES = {
+    "api.airplanes.live": float(os.getenv("ADSB_AIRPLANES_LIVE_RATE", "1.0")),
+    "airport-data.com": float(os.getenv("ADSB_AIRPORT_DATA_RATE", "1.0")),
+}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if POLLER_ENABLED:
+        poller.start()
+    if THUMBNAIL_PREFETCH:
+        thumbnail_prefetcher.start()
+    yield
+    await poller.stop()
+    await thumbnail_prefetcher.stop()
+    hex_batcher.clear()
+    await upstream.close()
+    thumbnail_cache.close()
+    registry.close()
+    if history is not None:
+        history.close()
+    if redis is not None:
+        await redis.aclose()
+    if recorder is not None:
+        recorder.close()
+
+
+app = FastAPI(root_path="/adsb", lifespan=lifespan)
+
+# ADSB source has a 1 per second rate limit, so delay requests per host to avoid being blocked. With Redis, that limit
+# is held cluster-wide rather than per process.
+if REDIS_URL:
+    from redis import asyncio as aioredis
+    redis = aioredis.from_url(REDIS_URL)
+    upstream = UpstreamClient(UPSTREAM_RATES, bucket_factory=lambda host, rate: RedisTokenBucket(redis, host, rate))
+    shared_hexes = RedisHexStore(redis, ttl=HEX_STATIC_TTL)
+else:
+    redis = None
+    upstream = UpstreamClient(UPSTREAM_RATES)
+    shared_hexes = None
+
+recorder = Recorder(RECORDING_PATH) if UPSTREAM_MODE == "record" else None
+replayer = Replayer(RECORDING_PATH, speed=REPLAY_SPEED) if UPSTREAM_MODE == "replay" else None
+
+hex_cache = HexCache(maxsize=16000, static_ttl=HEX_STATIC_TTL, live_ttl=HEX_LIVE_TTL)
+malformed_records = 0
+trails = TrailStore(max_aircraft=TRAIL_MAX_AIRCRAFT, points=TRAIL_POINTS)
+snapshots = SnapshotStore(maxsize=int(os.getenv("ADSB_SNAPSHOT_VERSIONS", "512")))
+thumbnail_cache = ThumbnailCache(os.path.join(DATA_DIR, "thumbnails.sqlite3"), maxsize=THUMBNAIL_MAX_ENTRIES)
+registry = AircraftRegistry(REGISTRY_PATH)
+history = HistoryStore(os.path.join(DATA_DIR, "history"), partition_seconds=HISTORY_PARTITION,
+                       retention=HISTORY_RETENTION_DAYS * 86400, lookback=HISTORY_LOOKBACK) if HISTORY_ENABLED else None
+
+radius_coalescer = RadiusCoalescer(window=COALESCE_WINDOW)
+spatial_index = SpatialIndex(cell_size=INDEX_CELL_SIZE, expiry=INDEX_EXPIRY, sweep_interval=INDEX_SWEEP_INTERVAL)
+query_planner = QueryPlanner(spatial_index, slot_cost=PLANNER_SLOT_COST, max_circles=PLANNER_MAX_CIRCLES,
+                             default_density=PLANNER_DEFAULT_DENSITY)
+
+
+# airplanes.live has a 1 request per second rate limit, so this waits on that host's bucket before going out over the
+# pooled connection. Other hosts (e.g. airport-data.com) have their own buckets and don't queue behind it.
+async def adsb_request(url: str):
+    if replayer is not None:
+        # Still paced by the bucket, so a replayed benchmark sees the same queueing as production would
+        await upstream.bucket(urlsplit(url).hostname).acquire()
+        return replayer.response(url)
+
+    response = await upstream.get(url)
+    if recorder is not None:
+        recorder.write(url, response)
+    return response
+
+
+async def fetch_point(lat: float, lon: float, radius: float):
+    url = f"https://api.airplanes.live/v2/point/{lat}/{lon}/{radius}"
+    aircraft_response = await adsb_request(url)
+
+    if aircraft_response.status_code != 200:
+        raise HTTPException(status_code=aircraft_response.status_code, detail=aircraft_response.text)
+
+    return aircraft_response.json()
 
-from cachetools import LRUCache
 
-app = FastAPI(root_path="/adsb")
+async def fetch_thumbnail(hex_code: str):
+    image = await asyncio.to_thread(thumbnail_cache.get, hex_code)
+    if image is not MISSING:
+        return image
 
-# ADSB source has a 1 per second rate limit, so globally delay requests to avoid being blocked
-rate_limit_lock = asyncio.Lock()
-last_request_time = 0
+    image_url = f"https://airport-data.com/api/ac_thumb.json?m={hex_code}"
+    image_response = await adsb_request(image_url)
 
-hex_cache = LRUCache(maxsize=16000)
-cache_lock = threading.Lock()
+    # Only a proper answer gets cached, negative or not. A failed request might work next time.
+    if image_response.status_code != 200:
+        return None
 
+    try:
+        image = image_response.json()["data"][0]["image"]
+    except (IndexError, KeyError):
+        image = None
 
-def update_cache(aircraft):
-    with cache_lock:
-        hex_cache.update({aircraft["hex"]: aircraft})
+    await asyncio.to_thread(thumbnail_cache.put, hex_code, image)
+    return image
 
 
-# airplanes.live has a 1 request per second rate limit, so this will wait for 1 second between requests
-async def adsb_request(url: str, delay: float = 1.0):
-    global last_request_time
-    async with rate_limit_lock:
-        while True:
-            current_time = asyncio.get_event_loop().time()
-            if current_time - last_request_time > delay:
-                last_request_time = current_time
-                return requests.get(url)
-            else:
-                await asyncio.sleep(delay - (current_time - last_request_time))
+thumbnail_prefetcher = ThumbnailPrefetcher(thumbnail_cache, fetch_thumbnail,
+                                           lambda: upstream.bucket("airport-data.com"), rate=THUMBNAIL_PREFETCH_RATE)
 
 
-@app.get("/radius")
-async def fetch_radius(sw_lat: float = Query(...), sw_lon: float = Query(...),
-                       ne_lat: float = Query(...), ne_lon: float = Query(...)):
+# Write-through to the shared cache. Losing Redis shouldn't take the service down with it, just make it less shared.
+async def share_hex_entries(records):
+    if shared_hexes is None:
+        return
+    try:
+        await shared_hexes.put_many(hex_cache.entries_for([ac["hex"] for ac in records]))
+    except Exception as e:
+        print(f"WARNING: Failed to write to shared hex cache: {e}")
+
+
+async def lookup_hexes(hex_list, fields):
+    results, missing = hex_cache.lookup(hex_list, fields)
+    if not missing or shared_hexes is None:
+        return results, missing
+
+    # Another worker may have fetched them recently
+    try:
+        hex_cache.load(await shared_hexes.get_many(missing))
+    except Exception as e:
+        print(f"WARNING: Failed to read from shared hex cache: {e}")
+        return results, missing
+
+    fresh, missing = hex_cache.lookup(missing, fields)
+    results.update(fresh)
+    return results, missing
+
+
+# Takes a whole upstream response, as its "now" (ms) is what seen_pos is relative to. Every position that comes
+# through here is also appended to its aircraft's trail and the history store.
+def normalise_aircraft(content, bbox=None):
+    global malformed_records
+    if not content["ac"]:
+        return [], []
+
+    now = content["now"] / 1000 if "now" in content else None
+    columns, malformed = normalise_columns(content["ac"], bbox, now)
+    if malformed:
+        malformed_records += malformed
+        print(f"WARNING: Skipped {malformed} aircraft with missing hex, position or track ({malformed_records} total)")
 
-    central_lat = (sw_lat + ne_lat) / 2
-    central_lon = (sw_lon + ne_lon) / 2
-    max_radius = haversine((sw_lat, sw_lon), (ne_lat, ne_lon), unit=Unit.NAUTICAL_MILES) / 2
+    trails.ingest(columns["hex"], columns["lat"], columns["lon"], columns["alt"], columns["position_time"])
+    if history is not None:
+        history.append(columns)
+    return records_from_columns(columns)
 
-    url = f"https://api.airplanes.live/v2/point/{central_lat}/{central_lon}/{max_radius}"
+
+# Fetch whichever cells of the box are older than max_age and fold the response into the index. Returns the plan used
+# to cover them, None if nothing needed refreshing.
+async def refresh_region(sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float, max_age: float = 0.0):
+    bbox = spatial_index.stale_bounds(sw_lat, sw_lon, ne_lat, ne_lon, max_age=max_age)
+    if bbox is None:
+        return None
+
+    plan = query_planner.plan(*bbox)
+
+    # Overlapping viewports share a single upstream fetch rather than queueing for their own
+    contents = await asyncio.gather(*(radius_coalescer.fetch(lat, lon, radius, fetch_point)
+                                      for lat, lon, radius in plan.circles))
+
+    for (lat, lon, radius), content in zip(plan.circles, contents):
+        await share_hex_entries(hex_cache.ingest(content["ac"]))
+
+        # Upstream queries a circle, so anything outside the cells we actually asked for is dropped here. It never
+        # answers for more than MAX_RADIUS_NM either, so nothing further out can be marked fresh.
+        records, motion = normalise_aircraft(content, bbox)
+        spatial_index.ingest(records, lat, lon, min(radius, MAX_RADIUS_NM), motion=motion, bounds=bbox)
+
+    return plan
+
+
+async def fetch_hexes(hex_list):
+    url = f"https://api.airplanes.live/v2/hex/{','.join(hex_list)}"
     aircraft_response = await adsb_request(url)
 
     if aircraft_response.status_code != 200:
         raise HTTPException(status_code=aircraft_response.status_code, detail=aircraft_response.text)
 
-    content = aircraft_response.json()
+    try:
+        hex_content = aircraft_response.json()
+        new_data = hex_content["ac"]
+    except (KeyError, IndexError):
+        raise HTTPException(status_code=404, detail="No aircraft found with the given hex values.")
 
-    filtered_content = {"ac": []}
-    for aircraft in content["ac"]:
+    merged = {ac["hex"]: ac for ac in hex_cache.ingest(new_data)}
+    await share_hex_entries(merged.values())
 
-        # Offload this to a separate thread as it's a secondary task
-        threading.Thread(target=lambda: update_cache(aircraft)).start()
+    # Positions are still worth keeping, even without knowing what else is around them
+    records, motion = normalise_aircraft(hex_content)
+    spatial_index.ingest(records, motion=motion)
+
+    return merged
+
+
+hex_batcher = HexBatcher(fetch_hexes, window=HEX_BATCH_WINDOW)
+
+
+background_refreshes = {}
 
-        # Some military aircraft don't seem to fill track, wacky
-        if "track" in aircraft:
-            track = aircraft["track"]
-        else:
-            try:
-                track = aircraft["calc_track"]
-            except KeyError:
-                continue
 
-        flight = aircraft["flight"] if "flight" in aircraft else "N/A"
+# Deduplicated by bbox, and held onto so the tasks aren't garbage collected mid-flight
+def schedule_refresh(sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float):
+    bbox = (sw_lat, sw_lon, ne_lat, ne_lon)
+    if bbox in background_refreshes:
+        return
 
+    async def refresh():
         try:
-            # Expecting a KeyError and skip here if there really is no data
-            lat = aircraft["lat"] if "lat" in aircraft else aircraft["lastPosition"]["lat"]
-            lon = aircraft["lon"] if "lon" in aircraft else aircraft["lastPosition"]["lon"]
+            await refresh_region(*bbox)
+        except Exception as e:
+            print(f"WARNING: Background refresh of {bbox} failed: {e}")
+        finally:
+            background_refreshes.pop(bbox, None)
 
-            subset = {
-                "hex": aircraft["hex"],
-                "lat": lat,
-                "lon": lon,
-                "track": track,
-                "flight": flight,
-            }
-            filtered_content["ac"].append(subset)
-        except KeyError:
-            print("ERROR: Missing key in aircraft data")
-            print(json.dumps(aircraft, indent=4))
+    background_refreshes[bbox] = asyncio.create_task(refresh())
 
-    return Response(content=json.dumps(filtered_content), media_type="application/json")
+
+def project_aircraft(records, at: float):
+    if not records:
+        return records
+
+    gs, position_time = zip(*spatial_index.motion(records))
+    lat, lon = extrapolate([r["lat"] for r in records], [r["lon"] for r in records], [r["track"] for r in records],
+                           gs, position_time, at, horizon=EXTRAPOLATE_HORIZON)
+    return [{**record, "lat": la, "lon": lo} for record, la, lo in zip(records, lat.tolist(), lon.tolist())]
+
+
+poller = DemandPoller(spatial_index, refresh_region, min_age=INDEX_MAX_AGE, clamped_min_age=POLLER_CLAMPED_MIN_AGE)
+
+
+@app.get("/radius")
+async def fetch_radius(sw_lat: float = Query(...), sw_lon: float = Query(...),
+                       ne_lat: float = Query(...), ne_lon: float = Query(...), since: int = Query(None, ge=0),
+                       at: float = Query(None), zoom: int = Query(None, ge=0, le=22), aggregate: str = Query(None),
+                       grid: int = Query(64, ge=1, le=512), accept: str = Header(None)):
+
+    summarise = zoom is not None or aggregate is not None
+    aggregate = (aggregate or AGGREGATE_DEFAULT).lower()
+    if aggregate not in ("clusters", "grid"):
+        raise HTTPException(status_code=400, detail="Aggregate must be one of: clusters,grid.")
+
+    # Everything up to the final query works on the snapped box, only the response is cut to exactly what was asked for
+    _, snapped = quantize_bbox(sw_lat, sw_lon, ne_lat, ne_lon, max_zoom=VIEWPORT_MAX_ZOOM)
+    poller.record(*snapped)
+
+    # Only go upstream for the parts of the viewport the index doesn't hold fresh enough data for. Once the poller is
+    # keeping watched regions warm that should just be the first look at somewhere new.
+    max_age = POLLER_MAX_AGE if poller.running else INDEX_MAX_AGE
+    headers = {}
+
+    # Stale-while-revalidate: rather than queue behind a deep upstream backlog, answer with whatever the index last had
+    # for the whole box (as long as it hasn't expired) and let a background refresh catch up
+    age = spatial_index.coverage_age(*snapped)
+    if age > max_age and age <= INDEX_EXPIRY and \
+            upstream.bucket("api.airplanes.live").estimated_wait() > WAIT_BUDGET:
+        schedule_refresh(*snapped)
+        headers = {"Age": str(int(age)), "X-Data-Age": f"{age:.1f}"}
+    else:
+        plan = await refresh_region(*snapped, max_age=max_age)
+        if plan is not None:
+            headers.update(plan.headers())
+
+    filtered_content = {"ac": spatial_index.query(sw_lat, sw_lon, ne_lat, ne_lon)}
+
+    # Dead-reckoned to the requested (unix) time, so clients can animate smoothly between polls
+    if at is not None:
+        filtered_content["ac"] = project_aircraft(filtered_content["ac"], at)
+
+    # Zoomed out too far for individual aircraft to be any use, so summarise them instead. Always JSON.
+    zoom = grid_zoom((sw_lat, sw_lon), (ne_lat, ne_lon), max_zoom=22) if zoom is None else zoom
+    if summarise and zoom < POINTS_MIN_ZOOM:
+        if aggregate == "grid":
+            counts = density_grid(filtered_content["ac"], sw_lat, sw_lon, ne_lat, ne_lon, grid, grid)
+            summary = {"rows": grid, "cols": grid, "bbox": [sw_lat, sw_lon, ne_lat, ne_lon], "counts": counts.tolist()}
+        else:
+            summary = clusters(filtered_content["ac"], zoom, cells_per_tile=CLUSTER_CELLS)
+        content = {"zoom": zoom, "total": len(filtered_content["ac"]), aggregate: summary}
+        return Response(content=json.dumps(content), media_type="application/json", headers=headers)
+
+    # Anything on a small enough screen is a candidate for being clicked on next
+    if len(filtered_content["ac"]) <= THUMBNAIL_PREFETCH_MAX_AIRCRAFT:
+        thumbnail_prefetcher.enqueue(aircraft["hex"] for aircraft in filtered_content["ac"])
+
+    # Versioned mode: only what was added, moved or removed since the client's last snapshot. Always JSON, as the
+    # columnar format only describes plain aircraft lists.
+    if since is not None:
+        filtered_content = snapshots.diff(filtered_content["ac"], since)
+    elif columnar.accepts_columnar(accept):
+        return Response(content=columnar.encode(filtered_content["ac"], RADIUS_FIELDS), media_type=columnar.MEDIA_TYPE,
+                        headers=headers)
+
+    return Response(content=json.dumps(filtered_content), media_type="application/json", headers=headers)
 
 
 @app.get("/hex")
-async def fetch_hex(hex: str = Query(...), image: bool = Query(False)):
+async def fetch_hex(hex: str = Query(...), image: bool = Query(False), fields: str = Query(None),
+                    accept: str = Header(None)):
 
     hex_list = [h.strip() for h in hex.split(",") if h.strip()]
     if not hex_list:
         raise HTTPException(status_code=400, detail="No hex provided.")
 
+    if fields is None:
+        values_to_keep = HEX_FIELDS
+    else:
+        values_to_keep = [f.strip() for f in fields.split(",") if f.strip()]
+        if not values_to_keep or any(f not in HEX_FIELDS for f in values_to_keep):
+            raise HTTPException(status_code=400, detail=f"Fields must be a subset of: {','.join(HEX_FIELDS)}.")
+
     if image and len(hex_list) > 1:
         raise HTTPException(status_code=400, detail="Image only supported for a single hex.")
 
-    results = {}
-    missing = []
+    # Static fields for airframes in the local registry never need to go upstream, only the live ones might
+    registered = registry.lookup_many(hex_list) if any(f in STATIC_FIELDS for f in values_to_keep) else {}
+    live_fields = [f for f in values_to_keep if f not in STATIC_FIELDS]
 
-    with cache_lock:
-        for h in hex_list:
-            if h in hex_cache:
-                results[h] = hex_cache[h]
-            else:
-                missing.append(h)
+    # Only use API for hexes where the fields being asked for have gone stale
+    results, missing = await lookup_hexes([h for h in hex_list if h not in registered], values_to_keep)
+    if registered and live_fields:
+        fresh, stale = await lookup_hexes(list(registered), live_fields)
+        results.update(fresh)
+        missing += stale
 
-    # Only use API for missing hexes
     if missing:
-        url = f"https://api.airplanes.live/v2/hex/{','.join(missing)}"
-        aircraft_response = await adsb_request(url)
-
-        if aircraft_response.status_code != 200:
-            raise HTTPException(status_code=aircraft_response.status_code, detail=aircraft_response.text)
+        # Misses from concurrent requests (the AI service's tool calls included) share upstream calls
+        for ac in (await hex_batcher.fetch(missing)).values():
+            results[ac["hex"]] = ac
 
-        try:
-            new_data = aircraft_response.json()["ac"]
-        except (KeyError, IndexError):
-            raise HTTPException(status_code=404, detail="No aircraft found with the given hex values.")
-
-        for ac in new_data:
-            h = ac.get("hex")
-            if h:
-                with cache_lock:
-                    hex_cache[h] = ac
-                results[h] = ac
+        # Upstream stops reporting aircraft once they're out of coverage, so fall back to whatever we last knew that
+        # hasn't expired. Old kinematics come back as None rather than as if they were current.
+        for h in missing:
+            if h not in results:
+                record = hex_cache.peek(h)
+                if record is not None:
+                    results[h] = record
 
-    values_to_keep = ["r", "t", "dbFlags", "gs", "ias", "tas", "desc", "alt_baro", "alt_geom", "seen"]
+    for h, record in registered.items():
+        results[h] = {**results.get(h, {}), **record}
 
     # Maintains original format, easier for backward-compat with the frontend code
     if len(hex_list) == 1:
@@ -144,16 +472,11 @@ async def fetch_hex(hex: str = Query(...), image: bool = Query(False)):
         filtered_content = {key: content.get(key, None) for key in values_to_keep}
 
         if image:
-            image_url = f"https://airport-data.com/api/ac_thumb.json?m={hex_val}"
-            image_response = await adsb_request(image_url)
+            filtered_content["image"] = await fetch_thumbnail(hex_val)
 
-            if image_response.status_code == 200:
-                try:
-                    filtered_content["image"] = image_response.json()["data"][0]["image"]
-                except (IndexError, KeyError):
-                    filtered_content["image"] = None
-            else:
-                filtered_content["image"] = None
+        if columnar.accepts_columnar(accept):
+            return Response(content=columnar.encode([filtered_content], list(filtered_content)),
+                            media_type=columnar.MEDIA_TYPE)
 
         return Response(content=json.dumps(filtered_content), media_type="application/json")
 
@@ -164,9 +487,74 @@ async def fetch_hex(hex: str = Query(...), image: bool = Query(False)):
             ac = results[h]
             output.append({key: ac.get(key, None) for key in values_to_keep})
 
+    if columnar.accepts_columnar(accept):
+        return Response(content=columnar.encode(output, values_to_keep), media_type=columnar.MEDIA_TYPE)
+
+    return Response(content=json.dumps(output), media_type="application/json")
+
+
+@app.get("/trail")
+async def fetch_trail(hex: str = Query(...), n: int = Query(None, ge=1)):
+
+    hex_list = [h.strip() for h in hex.split(",") if h.strip()]
+    if not hex_list:
+        raise HTTPException(status_code=400, detail="No hex provided.")
+
+    # Points are [time, lat, lon, alt], oldest first
+    output = {h: trails.trail(h, n) for h in hex_list if h in trails}
+    if not output:
+        raise HTTPException(status_code=404, detail="No trail found for the given hex values.")
+
     return Response(content=json.dumps(output), media_type="application/json")
 
 
+# Playback from the history store: everything in the box at one moment (at), or every position reported in it between
+# two (start, end), oldest first. Times are unix seconds.
+@app.get("/history")
+async def fetch_history(sw_lat: float = Query(...), sw_lon: float = Query(...), ne_lat: float = Query(...),
+                        ne_lon: float = Query(...), at: float = Query(None), start: float = Query(None),
+                        end: float = Query(None), limit: int = Query(10000, ge=1, le=100000),
+                        newest: bool = Query(False), accept: str = Header(None)):
+
+    if history is None:
+        raise HTTPException(status_code=404, detail="History is not enabled.")
+
+    if at is not None and (start is None and end is None):
+        columns = await asyncio.to_thread(history.at, sw_lat, sw_lon, ne_lat, ne_lon, at)
+    elif at is None and start is not None and end is not None and start <= end:
+        columns = await asyncio.to_thread(history.between, sw_lat, sw_lon, ne_lat, ne_lon, start, end)
+    else:
+        raise HTTPException(status_code=400, detail="Provide either at, or start and end (start <= end).")
+
+    # Cut down before building a dict per row, a busy box over a long window can hold far more than limit. Rows stay
+    # oldest first either way, newest just keeps the end of the window rather than the start.
+    truncated = len(columns["hex"]) > limit
+    keep = slice(-limit, None) if newest else slice(limit)
+    rows = history_records({name: values[keep] for name, values in columns.items()})
+
+    if columnar.accepts_columnar(accept):
+        return Response(content=columnar.encode(rows, HISTORY_FIELDS), media_type=columnar.MEDIA_TYPE,
+                        headers={"X-Truncated": str(truncated).lower()})
+
+    return Response(content=json.dumps({"ac": rows, "truncated": truncated}), media_type="application/json")
+
+
+@app.get("/stats")
+async def fetch_stats():
+    stats = {
+        "index": {"aircraft": len(spatial_index), "cells": len(spatial_index.cells)},
+        "coalescer": {"hits": radius_coalescer.hits, "misses": radius_coalescer.misses},
+        "hex_batches": hex_batcher.batches,
+        "hex_cache": {"entries": len(hex_cache)},
+        "thumbnails": {"entries": await asyncio.to_thread(len, thumbnail_cache), "hits": thumbnail_cache.hits,
+                       "misses": thumbnail_cache.misses},
+        "registry": {"entries": len(registry), "path": REGISTRY_PATH},
+        "trails": trails.stats(),
+        "malformed_records": malformed_records,
+    }
+    return Response(content=json.dumps(stats), media_type="application/json")
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
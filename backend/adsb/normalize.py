@@ -0,0 +1,138 @@
+import math
+import time
+
+import numpy as np
+
+
+# Upstream "ac" list to parallel columns, clipped to the bbox if one is given:
+#   - some military aircraft don't fill track, so calc_track is used instead
+#   - aircraft out of coverage only have lastPosition
+# Anything left without a hex, position or track is dropped and counted rather than logged one by one.
+# now is the upstream response's own timestamp (seconds), used to turn seen_pos into when the position was taken.
+# This runs on every upstream response (1000+ aircraft is normal). Pulling fields out of dicts can't be vectorised, so
+# it's done in a single pass that skips everything outside the bbox as soon as the position is known, and only the
+# survivors are turned into arrays. python normalize.py times it against the alternatives.
+def normalise_columns(aircraft_list, bbox=None, now=None):
+    now = time.time() if now is None else now
+    sw_lat, sw_lon, ne_lat, ne_lon = bbox if bbox is not None else (-math.inf, -math.inf, math.inf, math.inf)
+    hexes, flights, lats, lons, tracks, speeds, altitudes, times = [], [], [], [], [], [], [], []
+    malformed = 0
+
+    for aircraft in aircraft_list:
+        get = aircraft.get
+        lat, lon, seen_pos = get("lat"), get("lon"), get("seen_pos")
+        if lat is None or lon is None:
+            last = get("lastPosition") or {}
+            lat, lon, seen_pos = last.get("lat"), last.get("lon"), last.get("seen_pos")
+        elif seen_pos is None:
+            seen_pos = get("seen")
+        track = get("track")
+        if track is None:
+            track = get("calc_track")
+        hex_code = get("hex")
+
+        if not hex_code or lat is None or lon is None or track is None:
+            malformed += 1
+            continue
+        if not (sw_lat <= lat <= ne_lat and sw_lon <= lon <= ne_lon):
+            continue
+
+        # Barometric altitude is "ground" for aircraft on the ground, otherwise feet
+        alt = get("alt_baro")
+        if alt is None:
+            alt = get("alt_geom")
+        if alt.__class__ is not int and alt.__class__ is not float:
+            alt = 0.0 if alt == "ground" else None
+
+        hexes.append(hex_code)
+        flights.append(get("flight", "N/A"))
+        lats.append(lat)
+        lons.append(lon)
+        tracks.append(track)
+        speeds.append(get("gs"))
+        altitudes.append(alt)
+        times.append(now - seen_pos if seen_pos is not None else now)
+
+    # None comes out as NaN
+    columns = {
+        "hex": np.array(hexes, dtype=object),
+        "lat": np.array(lats, dtype=np.float64),
+        "lon": np.array(lons, dtype=np.float64),
+        "track": np.array(tracks, dtype=np.float64),
+        "flight": np.array(flights, dtype=object),
+        "gs": np.array(speeds, dtype=np.float64),
+        "alt": np.array(altitudes, dtype=np.float64),
+        "position_time": np.array(times, dtype=np.float64),
+    }
+    return columns, malformed
+
+
+# Same as above, back out as the per-aircraft dicts the rest of the service works with, plus a parallel list of
+# (ground speed, position time) for extrapolating each one later
+def normalise(aircraft_list, bbox=None, now=None):
+    if not aircraft_list:
+        return [], [], 0
+
+    columns, malformed = normalise_columns(aircraft_list, bbox, now)
+    records, motion = records_from_columns(columns)
+    return records, motion, malformed
+
+
+def records_from_columns(columns):
+    motion = list(zip(columns["gs"].tolist(), columns["position_time"].tolist()))
+    records = [
+        {"hex": h, "lat": la, "lon": lo, "track": tr, "flight": fl}
+        for h, la, lo, tr, fl in zip(columns["hex"].tolist(), columns["lat"].tolist(), columns["lon"].tolist(),
+                                     columns["track"].tolist(), columns["flight"].tolist())
+    ]
+    return records, motion
+
+
+# The per-aircraft loop this replaced (minus its logging), which only picked out the fields a record needs
+def _reference_records(aircraft_list):
+    filtered = []
+    for aircraft in aircraft_list:
+        if "track" in aircraft:
+            track = aircraft["track"]
+        elif "calc_track" in aircraft:
+            track = aircraft["calc_track"]
+        else:
+            continue
+        try:
+            lat = aircraft["lat"] if "lat" in aircraft else aircraft["lastPosition"]["lat"]
+            lon = aircraft["lon"] if "lon" in aircraft else aircraft["lastPosition"]["lon"]
+            filtered.append({"hex": aircraft["hex"], "lat": lat, "lon": lon, "track": track,
+                             "flight": aircraft["flight"] if "flight" in aircraft else "N/A"})
+        except KeyError:
+            pass
+    return filtered
+
+
+# python normalize.py [aircraft], times it against that loop over a synthetic upstream response that's mostly
+# ordinary aircraft
+if __name__ == "__main__":
+    import sys
+    import random
+    import timeit
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1500
+    rng = random.Random(0)
+    response = []
+    for i in range(count):
+        aircraft = {"hex": f"{i:06x}", "type": "adsb_icao", "flight": f"TST{i} ", "r": "G-TEST", "t": "A320",
+                    "alt_baro": "ground" if i % 20 == 0 else rng.randint(0, 45000), "gs": rng.uniform(0, 500),
+                    "squawk": "7000", "category": "A3", "messages": rng.randint(0, 10 ** 6), "seen": rng.uniform(0, 5),
+                    "rssi": -20.0}
+        if i % 25:
+            aircraft.update(lat=rng.uniform(40, 60), lon=rng.uniform(-10, 30), seen_pos=rng.uniform(0, 5))
+        else:
+            aircraft["lastPosition"] = {"lat": rng.uniform(40, 60), "lon": rng.uniform(-10, 30), "seen_pos": 30.0}
+        aircraft["track" if i % 50 else "calc_track"] = rng.uniform(0, 360)
+        response.append(aircraft)
+
+    bbox, now = (45, 0, 55, 20), time.time()
+    for name, run in (("loop, records only", lambda: _reference_records(response)),
+                      ("normalise_columns", lambda: normalise_columns(response, bbox, now)),
+                      ("normalise", lambda: normalise(response, bbox, now))):
+        runs, total = timeit.Timer(run).autorange()
+        print(f"{name:>18}: {total / runs * 1000:.3f} ms per {count} aircraft")
@@ -0,0 +1,72 @@
+import math
+
+from spatial import EARTH_RADIUS_NM, enclosing_circle
+
+# airplanes.live won't answer point queries any wider than this
+MAX_RADIUS_NM = 250.0
+
+
+# Area (square nm) of a circle drawn on the sphere, which matters once radii get into the hundreds of miles
+def circle_area(radius: float):
+    return 2 * math.pi * EARTH_RADIUS_NM ** 2 * (1 - math.cos(radius / EARTH_RADIUS_NM))
+
+
+class QueryPlan:
+    def __init__(self, rows: int, cols: int, circles, density: float, estimated: bool, slot_cost: float,
+                 clamped: bool = False):
+        self.rows = rows
+        self.cols = cols
+        self.circles = circles  # [(lat, lon, radius)]
+        self.density = density
+        self.estimated = estimated
+        self.aircraft = density * sum(circle_area(radius) for _, _, radius in circles)
+        self.cost = self.aircraft + slot_cost * len(circles)
+        self.oversized = any(radius > MAX_RADIUS_NM for _, _, radius in circles)
+        self.clamped = clamped
+
+    # Debug headers describing the plan, for /radius responses
+    def headers(self):
+        return {
+            "X-Query-Plan": f"{self.rows}x{self.cols}" + (" (clamped)" if self.clamped else ""),
+            "X-Query-Circles": ";".join(f"{lat:.4f},{lon:.4f},{radius:.1f}" for lat, lon, radius in self.circles),
+            "X-Query-Cost": f"{self.cost:.1f}",
+            "X-Query-Density": f"{self.density:.5f}" + ("" if self.estimated else " (default)"),
+        }
+
+
+# Decides how to cover a bbox with upstream point queries. One circle around the whole box is the cheapest on rate
+# limit slots, but for long thin boxes (or ones stretched by being near the poles) it drags in far more area than was
+# asked for. Every way of splitting the box into a rows x cols grid of up to max_circles circles is costed as expected
+# aircraft in the payload (recent density from the index x area covered) plus slot_cost aircraft-equivalents per
+# upstream call, and the cheapest wins.
+class QueryPlanner:
+    def __init__(self, index, slot_cost: float = 100.0, max_circles: int = 6, default_density: float = 0.002):
+        self.index = index
+        self.slot_cost = slot_cost
+        self.max_circles = max_circles
+        self.default_density = default_density
+
+    def candidates(self, sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float, density: float, estimated: bool):
+        height, width = ne_lat - sw_lat, ne_lon - sw_lon
+        for rows in range(1, self.max_circles + 1):
+            for cols in range(1, self.max_circles // rows + 1):
+                circles = [enclosing_circle(sw_lat + height * r / rows, sw_lon + width * c / cols,
+                                            sw_lat + height * (r + 1) / rows, sw_lon + width * (c + 1) / cols)
+                           for r in range(rows) for c in range(cols)]
+                yield QueryPlan(rows, cols, circles, density, estimated, self.slot_cost)
+
+    def plan(self, sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float, now=None):
+        density = self.index.density(sw_lat, sw_lon, ne_lat, ne_lon, now=now)
+        estimated = density is not None
+        density = density if estimated else self.default_density
+
+        plans = list(self.candidates(sw_lat, sw_lon, ne_lat, ne_lon, density, estimated))
+        fitting = [plan for plan in plans if not plan.oversized]
+        if fitting:
+            return min(fitting, key=lambda plan: plan.cost)
+
+        # Too big to cover in max_circles queries upstream will answer, so send the finest grid with every circle cut
+        # down to the cap. Only what those reach gets marked fresh, the rest stays stale until someone zooms in.
+        finest = min(plans, key=lambda plan: max(radius for _, _, radius in plan.circles))
+        circles = [(lat, lon, min(radius, MAX_RADIUS_NM)) for lat, lon, radius in finest.circles]
+        return QueryPlan(finest.rows, finest.cols, circles, density, estimated, self.slot_cost, clamped=True)
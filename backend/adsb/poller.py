@@ -0,0 +1,117 @@
+import math
+import time
+import asyncio
+import traceback
+import sys
+
+
+class _Region:
+    def __init__(self, bbox, now: float):
+        self.bbox = bbox
+        self.demand = 0.0
+        self.last_seen = now
+        self.clamped_at = None  # when it was last refreshed, if it's too big for upstream to ever cover all of it
+
+    # Exponentially decayed request count, so a viewport that was popular ten minutes ago doesn't win forever
+    def score(self, now: float, half_life: float):
+        return self.demand * math.pow(0.5, (now - self.last_seen) / half_life)
+
+
+# Spends the upstream budget on whatever users are looking at: every tick the region with the highest
+# (recent demand x data age) is refreshed into the spatial index, and request handlers just read from that. Regions
+# too big to cover within upstream's radius cap (see planner.QueryPlan.clamped) never come out fully fresh, so their age
+# is taken from their last refresh instead, and they wait at least clamped_min_age between refreshes as each one costs
+# a full grid of upstream calls.
+class DemandPoller:
+    def __init__(self, index, refresh, interval: float = 1.0, half_life: float = 30.0, idle_after: float = 120.0,
+                 min_age: float = 1.0, max_regions: int = 256, clamped_min_age: float = 30.0):
+        self.index = index
+        self.refresh = refresh
+        self.interval = interval
+        self.half_life = half_life
+        self.idle_after = idle_after
+        self.min_age = min_age
+        self.max_regions = max_regions
+        self.clamped_min_age = clamped_min_age
+        self.regions = {}
+        self.running = False
+        self.task = None
+
+    def clear(self):
+        self.regions.clear()
+
+    def record(self, sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float, now=None):
+        now = time.time() if now is None else now
+        bbox = (sw_lat, sw_lon, ne_lat, ne_lon)
+
+        region = self.regions.get(bbox)
+        if region is None:
+            if len(self.regions) >= self.max_regions:
+                coldest = min(self.regions.values(), key=lambda r: r.score(now, self.half_life))
+                del self.regions[coldest.bbox]
+            region = self.regions[bbox] = _Region(bbox, now)
+
+        region.demand = region.score(now, self.half_life) + 1
+        region.last_seen = now
+
+    # Age of the stalest cell in the region, capped so a never-fetched region doesn't drown out demand entirely
+    def _age(self, region, now: float):
+        if region.clamped_at is not None:
+            return min(now - region.clamped_at, self.idle_after)
+        return min(self.index.coverage_age(*region.bbox, now=now), self.idle_after)
+
+    def next_region(self, now=None):
+        now = time.time() if now is None else now
+
+        for bbox in [bbox for bbox, region in self.regions.items() if now - region.last_seen > self.idle_after]:
+            del self.regions[bbox]
+
+        best, best_priority = None, 0.0
+        for region in self.regions.values():
+            age = self._age(region, now)
+            if age < (self.min_age if region.clamped_at is None else self.clamped_min_age):
+                continue
+            priority = region.score(now, self.half_life) * age
+            if priority > best_priority:
+                best, best_priority = region, priority
+
+        return best.bbox if best else None
+
+    # Refreshes whichever region needs it most, returning its bbox, or None if nothing does
+    async def refresh_next(self):
+        bbox = self.next_region()
+        if bbox is None:
+            return None
+
+        plan = await self.refresh(*bbox)
+        region = self.regions.get(bbox)
+        if region is not None:
+            region.clamped_at = time.time() if plan is not None and plan.clamped else None
+        return bbox
+
+    async def run(self):
+        self.running = True
+        try:
+            while True:
+                try:
+                    # The upstream rate limiter paces this loop, so there's no need for a sleep of our own
+                    if await self.refresh_next() is None:
+                        await asyncio.sleep(self.interval)
+                except Exception:
+                    traceback.print_exc(file=sys.stdout)
+                    await asyncio.sleep(self.interval)
+        finally:
+            self.running = False
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
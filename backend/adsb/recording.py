@@ -0,0 +1,152 @@
+import gzip
+import json
+import time
+import bisect
+import threading
+from urllib.parse import urlsplit
+
+import httpx
+from haversine import haversine, Unit
+
+# Upstream traffic capture for offline benchmarking. A recording is gzipped JSON lines, one per upstream response:
+#   {"t": unix seconds, "url": ..., "status": ..., "body": response text}
+# Each flush appends a new gzip member, which gzip readers treat as one continuous stream.
+
+
+class Recorder:
+    def __init__(self, path: str, flush_every: int = 50, flush_interval: float = 5.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def write(self, url: str, response, now=None):
+        now = time.time() if now is None else now
+        line = json.dumps({"t": now, "url": url, "status": response.status_code, "body": response.text})
+        with self.lock:
+            self.buffer.append(line)
+            if len(self.buffer) >= self.flush_every or now - self.last_flush >= self.flush_interval:
+                self._flush(now)
+
+    def _flush(self, now: float):
+        if self.buffer:
+            with gzip.open(self.path, "at", encoding="utf-8") as f:
+                f.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+        self.last_flush = now
+
+    def close(self):
+        with self.lock:
+            self._flush(time.time())
+
+
+def _point(url: str):
+    # .../v2/point/{lat}/{lon}/{radius}
+    parts = urlsplit(url).path.rstrip("/").split("/")
+    if len(parts) >= 4 and parts[-4] == "point":
+        return float(parts[-3]), float(parts[-2]), float(parts[-1])
+    return None
+
+
+def _hexes(url: str):
+    parts = urlsplit(url).path.rstrip("/").split("/")
+    if len(parts) >= 2 and parts[-2] == "hex":
+        return [h for h in parts[-1].split(",") if h]
+    return None
+
+
+# Plays a recording back with no network. The replay clock starts at the first recorded response and runs at `speed`
+# times real time. Requests get the newest response at or before the replay clock: the exact URL if it was recorded,
+# otherwise the closest covering point query (trimmed to the requested circle), or, for hex lookups, each aircraft's
+# latest sighting anywhere in the recording.
+class Replayer:
+    def __init__(self, path: str, speed: float = 1.0):
+        self.speed = speed
+        self.by_url = {}     # url -> ([t], [record])
+        self.points = []     # (t, lat, lon, radius, record)
+        self.sightings = {}  # hex -> ([t], [aircraft])
+
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            records = sorted((json.loads(line) for line in f if line.strip()), key=lambda r: r["t"])
+
+        for record in records:
+            times, entries = self.by_url.setdefault(record["url"], ([], []))
+            times.append(record["t"])
+            entries.append(record)
+
+            if record["status"] != 200:
+                continue
+            point = _point(record["url"])
+            if point is not None:
+                self.points.append((record["t"], *point, record))
+            for aircraft in json.loads(record["body"]).get("ac") or []:
+                if "hex" in aircraft:
+                    times, seen = self.sightings.setdefault(aircraft["hex"], ([], []))
+                    times.append(record["t"])
+                    seen.append(aircraft)
+
+        self.start = records[0]["t"] if records else time.time()
+        self.end = records[-1]["t"] if records else self.start
+        self.started_at = time.time()
+
+    def clock(self, now=None):
+        now = time.time() if now is None else now
+        return min(self.start + (now - self.started_at) * self.speed, self.end)
+
+    @staticmethod
+    def _latest(times, entries, at: float):
+        index = bisect.bisect_right(times, at)
+        return entries[index - 1] if index else None
+
+    def _response(self, url: str, status: int, body, at: float, recorded_at: float):
+        # Shift the response's own timestamp so seen/seen_pos ages line up with the wall clock
+        if isinstance(body, dict) and "now" in body:
+            body = {**body, "now": (time.time() - (at - recorded_at) / self.speed) * 1000}
+        content = json.dumps(body) if not isinstance(body, str) else body
+        return httpx.Response(status, content=content.encode(), request=httpx.Request("GET", url))
+
+    def response(self, url: str, now=None):
+        at = self.clock(now)
+
+        if url in self.by_url:
+            record = self._latest(*self.by_url[url], at) or self.by_url[url][1][0]
+            body = json.loads(record["body"]) if record["status"] == 200 else record["body"]
+            return self._response(url, record["status"], body, at, record["t"])
+
+        point = _point(url)
+        if point is not None:
+            return self._point_response(url, point, at)
+
+        hexes = _hexes(url)
+        if hexes is not None:
+            found = [self._latest(*self.sightings[h], at) for h in hexes if h in self.sightings]
+            return self._response(url, 200, {"ac": [a for a in found if a is not None], "now": at * 1000}, at, at)
+
+        return httpx.Response(404, text="Not in recording", request=httpx.Request("GET", url))
+
+    def _point_response(self, url: str, point, at: float):
+        lat, lon, radius = point
+        candidates = [p for p in self.points if p[0] <= at] or self.points[:1]
+        if not candidates:
+            return self._response(url, 200, {"ac": [], "now": at * 1000}, at, at)
+
+        # Prefer the newest recorded circle that covers this one, otherwise whichever is closest
+        def distance(p):
+            return haversine((lat, lon), (p[1], p[2]), unit=Unit.NAUTICAL_MILES)
+
+        covering = [p for p in candidates if distance(p) + radius <= p[3]]
+        t, p_lat, p_lon, p_radius, record = covering[-1] if covering else min(candidates, key=distance)
+
+        body = json.loads(record["body"])
+        inside = []
+        for aircraft in body.get("ac") or []:
+            position = (aircraft.get("lat"), aircraft.get("lon"))
+            if None in position:
+                last = aircraft.get("lastPosition") or {}
+                position = (last.get("lat"), last.get("lon"))
+            if None not in position and haversine((lat, lon), position, unit=Unit.NAUTICAL_MILES) <= radius:
+                inside.append(aircraft)
+
+        return self._response(url, 200, {**body, "ac": inside}, at, t)
@@ -0,0 +1,159 @@
+import os
+import io
+import sys
+import csv
+import gzip
+import mmap
+import struct
+import threading
+
+# Local copy of the static registry fields (r, t, desc, dbFlags) for every known airframe, so /hex only has to go
+# upstream for the live ones. Built offline from the tar1090-db / readsb aircraft.csv.gz dump with
+#   python registry.py aircraft.csv.gz registry.bin
+# and memory-mapped on first use, so nothing is parsed at startup and the OS pages in only what gets looked up.
+#
+# Layout, little-endian:
+#   header  b"AREG", uint16 version, uint16 reserved, uint32 entries, uint32 slots
+#   table   slots x (uint32 icao, uint32 offset), an open-addressed hash table with linear probing, EMPTY where unused
+#   records uint16 length + utf-8 "r\x1ft\x1fdesc\x1fdbFlags", at offsets from the start of the file
+
+MAGIC = b"AREG"
+VERSION = 1
+HEADER = struct.Struct("<4sHHII")
+SLOT = struct.Struct("<II")
+LENGTH = struct.Struct("<H")
+EMPTY = 0xFFFFFFFF
+SEPARATOR = "\x1f"
+
+
+def _icao(hex_code: str):
+    try:
+        value = int(hex_code, 16)
+    except ValueError:
+        return None  # e.g. "~"-prefixed TIS-B addresses, which aren't airframes
+    return value if 0 <= value < EMPTY else None
+
+
+def _home(icao: int, slots: int):
+    return ((icao * 0x9E3779B1) & 0xFFFFFFFF) % slots
+
+
+# readsb writes dbFlags as a string of 0/1 characters (military, interesting, PIA, LADD), upstream as the bitfield
+def _flags(value: str):
+    return sum(1 << i for i, c in enumerate(value.strip()) if c == "1")
+
+
+def build(entries, path: str):
+    entries = {icao: record for icao, record in entries}
+    slots = max(8, 1 << (2 * len(entries) - 1).bit_length())  # at most half full, so probes stay short
+    table = [(EMPTY, 0)] * slots
+
+    blob = io.BytesIO()
+    offset = HEADER.size + slots * SLOT.size
+    for icao, record in entries.items():
+        data = SEPARATOR.join(str(record.get(key, "")) for key in ("r", "t", "desc", "dbFlags")).encode("utf-8")
+        slot = _home(icao, slots)
+        while table[slot][0] != EMPTY:
+            slot = (slot + 1) % slots
+        table[slot] = (icao, offset + blob.tell())
+        blob.write(LENGTH.pack(len(data)) + data)
+
+    # Written alongside and swapped in, so a running service never maps half a file
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(entries), slots))
+        f.write(b"".join(SLOT.pack(*entry) for entry in table))
+        f.write(blob.getvalue())
+    os.replace(temporary, path)
+    return len(entries)
+
+
+# icao;registration;type;flags;description;... lines, as in tar1090-db's aircraft.csv.gz
+def read_dump(path: str):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="") as f:
+        for row in csv.reader(f, delimiter=";"):
+            if len(row) < 5:
+                continue
+            icao = _icao(row[0].strip())
+            if icao is None:
+                continue
+            record = {"r": row[1].strip(), "t": row[2].strip(), "desc": row[4].strip(), "dbFlags": _flags(row[3])}
+            yield icao, record
+
+
+class AircraftRegistry:
+    def __init__(self, path: str):
+        self.path = path
+        self.map = None
+        self.entries = 0
+        self.slots = 0
+        self.opened = False
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        self._open()
+        return self.entries
+
+    # Only the first lookup pays for opening, and a missing or unreadable file just means nothing is known locally
+    def _open(self):
+        if self.opened:
+            return self.map
+        with self.lock:
+            if not self.opened:
+                try:
+                    with open(self.path, "rb") as f:
+                        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    magic, version, _, entries, slots = HEADER.unpack_from(mapped, 0)
+                    if magic != MAGIC or version != VERSION:
+                        raise ValueError(f"not a version {VERSION} registry")
+                    self.map, self.entries, self.slots = mapped, entries, slots
+                except (OSError, ValueError, struct.error) as e:
+                    if not isinstance(e, FileNotFoundError):
+                        print(f"WARNING: Aircraft registry at {self.path} unusable: {e}")
+                self.opened = True
+        return self.map
+
+    def lookup(self, hex_code: str):
+        mapped = self._open()
+        icao = _icao(hex_code)
+        if mapped is None or icao is None or not self.slots:
+            return None
+
+        slot = _home(icao, self.slots)
+        while True:
+            key, offset = SLOT.unpack_from(mapped, HEADER.size + slot * SLOT.size)
+            if key == EMPTY:
+                return None
+            if key == icao:
+                break
+            slot = (slot + 1) % self.slots
+
+        (length,) = LENGTH.unpack_from(mapped, offset)
+        start = offset + LENGTH.size
+        r, t, desc, flags = mapped[start:start + length].decode("utf-8").split(SEPARATOR)
+        record = {key: value for key, value in (("r", r), ("t", t), ("desc", desc)) if value}
+        record["dbFlags"] = int(flags or 0)
+        return record
+
+    def lookup_many(self, hex_list):
+        found = {}
+        for hex_code in hex_list:
+            record = self.lookup(hex_code)
+            if record is not None:
+                found[hex_code] = record
+        return found
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+            self.map = None
+            self.opened = False
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("Usage: python registry.py <aircraft.csv[.gz]> <registry.bin>")
+    count = build(read_dump(sys.argv[1]), sys.argv[2])
+    print(f"Wrote {count} aircraft to {sys.argv[2]}")
@@ -0,0 +1,82 @@
+import json
+import asyncio
+
+from redis.exceptions import RedisError
+
+from upstream import TokenBucket
+
+# Redis-backed pieces for running adsb as more than one worker or replica, so they share one view of the aircraft
+# cache and, more importantly, one upstream rate limit instead of each getting its own.
+
+
+# Cluster-wide equivalent of upstream.TokenBucket: a slot is a key that exists for 1/rate seconds, so only one holder
+# across every process can take it per interval. Local waiters still queue on a lock to keep them in order. If Redis
+# can't be reached, this process falls back to a local bucket at the same rate (so briefly up to one rate per worker)
+# for retry_after seconds before trying Redis again, rather than failing every upstream call.
+class RedisTokenBucket:
+    def __init__(self, redis, host: str, rate: float, prefix: str = "adsb:rate", retry_after: float = 10.0):
+        self.redis = redis
+        self.key = f"{prefix}:{host}"
+        self.rate = rate
+        self.interval_ms = max(1, int(1000 / rate))
+        self.retry_after = retry_after
+        self.fallback = TokenBucket(rate)
+        self.down_until = None
+        self.waiting = 0
+        self.lock = asyncio.Lock()
+
+    # Only knows about this process's queue, other workers' waiters are invisible from here
+    def estimated_wait(self):
+        return (self.waiting + self.fallback.waiting) / self.rate
+
+    async def acquire(self):
+        now = asyncio.get_event_loop().time()
+        if self.down_until is not None and now < self.down_until:
+            return await self.fallback.acquire()
+
+        self.waiting += 1
+        try:
+            async with self.lock:
+                while True:
+                    if await self.redis.set(self.key, 1, px=self.interval_ms, nx=True):
+                        self.down_until = None
+                        return
+                    remaining = await self.redis.pttl(self.key)
+                    await asyncio.sleep(max(remaining, 1) / 1000)
+        except RedisError as e:
+            print(f"WARNING: Shared rate limit unavailable, limiting locally for {self.retry_after:.0f}s: {e}")
+            self.down_until = asyncio.get_event_loop().time() + self.retry_after
+        finally:
+            self.waiting -= 1
+        return await self.fallback.acquire()
+
+
+# Second tier behind each process's HexCache. Entries carry the same ingest timestamps as the local cache so freshness
+# is judged the same way, and expire from Redis once even their static half would be stale.
+class RedisHexStore:
+    def __init__(self, redis, ttl: float, prefix: str = "adsb:hex"):
+        self.redis = redis
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    def _key(self, hex_code):
+        return f"{self.prefix}:{hex_code}"
+
+    async def get_many(self, hex_list):
+        if not hex_list:
+            return {}
+        values = await self.redis.mget([self._key(h) for h in hex_list])
+        return {h: tuple(json.loads(value)) for h, value in zip(hex_list, values) if value is not None}
+
+    async def put_many(self, entries):
+        if not entries:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for hex_code, entry in entries.items():
+                pipe.set(self._key(hex_code), json.dumps(entry), ex=self.ttl)
+            await pipe.execute()
+
+    async def clear(self):
+        keys = [key async for key in self.redis.scan_iter(f"{self.prefix}:*")]
+        if keys:
+            await self.redis.delete(*keys)
@@ -0,0 +1,232 @@
+import math
+import time
+
+from haversine import haversine, Unit
+
+EARTH_RADIUS_NM = 6371.0088 / 1.852
+
+
+# Smallest circle around the box's centre that reaches every corner. Half the diagonal misses the equatorward corners
+# slightly, which matters once we start trusting that a circle fully covers a set of cells.
+def enclosing_circle(sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float):
+    lat = (sw_lat + ne_lat) / 2
+    lon = (sw_lon + ne_lon) / 2
+    corners = [(sw_lat, sw_lon), (sw_lat, ne_lon), (ne_lat, sw_lon), (ne_lat, ne_lon)]
+    radius = max(haversine((lat, lon), corner, unit=Unit.NAUTICAL_MILES) for corner in corners)
+    return lat, lon, radius * 1.001
+
+
+# Fixed-size lat/lon grid holding the latest known position of every aircraft we've seen, plus when each cell was last
+# fully covered by an upstream response. Cells are keyed by integer (row, column) so lookups never touch empty space.
+# Anything older than expiry is swept out every sweep_interval seconds (on ingest), so aircraft and coverage in areas
+# nobody looks at again don't pile up for the life of the process.
+class SpatialIndex:
+    def __init__(self, cell_size: float = 0.1, expiry: float = 60.0, sweep_interval: float = 30.0):
+        self.cell_size = cell_size
+        self.expiry = expiry
+        self.sweep_interval = sweep_interval
+        self.cells = {}       # (row, col) -> set of hexes
+        self.aircraft = {}    # hex -> (record, cell, updated_at, motion)
+        self.coverage = {}    # (row, col) -> time last fully covered
+        self.last_sweep = -math.inf
+
+    def __len__(self):
+        return len(self.aircraft)
+
+    def clear(self):
+        self.cells.clear()
+        self.aircraft.clear()
+        self.coverage.clear()
+        self.last_sweep = -math.inf
+
+    def sweep(self, now=None):
+        now = time.time() if now is None else now
+        self.last_sweep = now
+        self.coverage = {cell: covered_at for cell, covered_at in self.coverage.items()
+                         if now - covered_at <= self.expiry}
+        for hex_code in [hex_code for hex_code, (_, _, updated_at, _) in self.aircraft.items()
+                         if now - updated_at > self.expiry]:
+            self._remove(hex_code)
+
+    def cell(self, lat: float, lon: float):
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    # A box ending exactly on the antimeridian or a pole (as snapped viewports do) stops at the last real cell rather
+    # than reaching one past it
+    def cell_range(self, sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float):
+        (row_min, col_min), (row_max, col_max) = self.cell(sw_lat, sw_lon), self.cell(ne_lat, ne_lon)
+        last_row, last_col = self.cell(90.0 - 1e-9, 180.0 - 1e-9)
+        return row_min, col_min, min(row_max, last_row), min(col_max, last_col)
+
+    # Bounding box of a set of cells, i.e. the area an upstream query needs to cover to refresh all of them. Kept on
+    # the globe, as a box ending exactly on the antimeridian or a pole puts its last cell just past it.
+    def cell_bounds(self, cells):
+        rows = [row for row, _ in cells]
+        cols = [col for _, col in cells]
+        size = self.cell_size
+        return (max(min(rows) * size, -90.0), max(min(cols) * size, -180.0),
+                min((max(rows) + 1) * size, 90.0), min((max(cols) + 1) * size, 180.0))
+
+    # Recently enough covered cells in the range, found from whichever is smaller: the range or the coverage we hold.
+    # Zoomed right out a box can span millions of cells, but the check only ever costs as much as what's tracked.
+    def _fresh_cells(self, row_min: int, col_min: int, row_max: int, col_max: int, max_age: float, now: float):
+        if (row_max - row_min + 1) * (col_max - col_min + 1) > len(self.coverage):
+            cells = [cell for cell in self.coverage
+                     if row_min <= cell[0] <= row_max and col_min <= cell[1] <= col_max]
+        else:
+            cells = [(row, col) for row in range(row_min, row_max + 1) for col in range(col_min, col_max + 1)
+                     if (row, col) in self.coverage]
+        return [cell for cell in cells if now - self.coverage[cell] <= max_age]
+
+    # Bounding box of the cells in the box older than max_age (or never covered), i.e. what an upstream query needs to
+    # cover to refresh all of them. None if it's all fresh enough.
+    def stale_bounds(self, sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float, max_age: float, now=None):
+        now = time.time() if now is None else now
+        row_min, col_min, row_max, col_max = self.cell_range(sw_lat, sw_lon, ne_lat, ne_lon)
+        height, width = row_max - row_min + 1, col_max - col_min + 1
+
+        fresh_rows, fresh_cols = {}, {}
+        for row, col in self._fresh_cells(row_min, col_min, row_max, col_max, max_age, now):
+            fresh_rows[row] = fresh_rows.get(row, 0) + 1
+            fresh_cols[col] = fresh_cols.get(col, 0) + 1
+
+        # A row (or column) holds something stale unless every cell along it is fresh, so walking in from each edge
+        # stops at most one past the fully fresh ones
+        first_row = next((row for row in range(row_min, row_max + 1) if fresh_rows.get(row, 0) < width), None)
+        if first_row is None:
+            return None
+        last_row = next(row for row in range(row_max, row_min - 1, -1) if fresh_rows.get(row, 0) < width)
+        first_col = next(col for col in range(col_min, col_max + 1) if fresh_cols.get(col, 0) < height)
+        last_col = next(col for col in range(col_max, col_min - 1, -1) if fresh_cols.get(col, 0) < height)
+        return self.cell_bounds([(first_row, first_col), (last_row, last_col)])
+
+    # Age of the stalest cell in the box, infinite if any part of it has never been covered
+    def coverage_age(self, sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float, now=None):
+        now = time.time() if now is None else now
+        row_min, col_min, row_max, col_max = self.cell_range(sw_lat, sw_lon, ne_lat, ne_lon)
+        covered = self._fresh_cells(row_min, col_min, row_max, col_max, math.inf, now)
+        if len(covered) < (row_max - row_min + 1) * (col_max - col_min + 1):
+            return math.inf
+        return now - min((self.coverage[cell] for cell in covered), default=now)
+
+    # Aircraft per square nautical mile over the cells in the box that upstream has covered recently enough to trust,
+    # None if there aren't any
+    def density(self, sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float, now=None):
+        now = time.time() if now is None else now
+        row_min, col_min, row_max, col_max = self.cell_range(sw_lat, sw_lon, ne_lat, ne_lon)
+
+        side = self.cell_size * 60
+        area = count = 0
+        for row, col in self._fresh_cells(row_min, col_min, row_max, col_max, self.expiry, now):
+            area += side * side * math.cos(math.radians((row + 0.5) * self.cell_size))
+            count += len(self.cells.get((row, col), ()))
+        return count / area if area > 0 else None
+
+    # Cells lying entirely within the circle, worked out a row at a time from the circle's longitudinal half-width
+    def covered_cells(self, lat: float, lon: float, radius: float):
+        size = self.cell_size
+        d = radius / EARTH_RADIUS_NM
+        lat0 = math.radians(lat)
+        reach = math.degrees(d)
+
+        def half_width(edge_lat):
+            phi = math.radians(edge_lat)
+            denominator = math.cos(phi) * math.cos(lat0)
+            if denominator <= 0:
+                return None
+            value = (math.cos(d) - math.sin(phi) * math.sin(lat0)) / denominator
+            if value > 1:
+                return None
+            return 180.0 if value < -1 else math.degrees(math.acos(value))
+
+        cells = []
+        for row in range(math.floor((lat - reach) / size), math.floor((lat + reach) / size) + 1):
+            widths = [half_width(row * size), half_width((row + 1) * size)]
+            if None in widths:
+                continue
+            width = min(widths)
+            col_min = math.ceil((lon - width) / size)
+            col_max = math.floor((lon + width) / size) - 1
+            cells.extend((row, col) for col in range(col_min, col_max + 1))
+        return cells
+
+    # Whether the whole cell lies within the bbox, with a little slack for cell_bounds() rounding
+    def _inside(self, cell, bounds):
+        sw_lat, sw_lon, ne_lat, ne_lon = bounds
+        row, col = cell
+        size, slack = self.cell_size, self.cell_size * 1e-6
+        return row * size >= sw_lat - slack and (row + 1) * size <= ne_lat + slack and \
+            col * size >= sw_lon - slack and (col + 1) * size <= ne_lon + slack
+
+    def _remove(self, hex_code):
+        _, cell, _, _ = self.aircraft.pop(hex_code)
+        members = self.cells.get(cell)
+        if members is not None:
+            members.discard(hex_code)
+            if not members:
+                del self.cells[cell]
+
+    # Records need at least hex/lat/lon, motion is an optional parallel list of (ground speed, position time). If the
+    # circle an upstream response came from is given, the cells it fully covers are marked fresh and anything we still
+    # had in them that didn't come back has left (or landed). If the records were clipped to a bbox, pass it as bounds
+    # so cells outside it aren't marked too.
+    def ingest(self, records, lat=None, lon=None, radius=None, now=None, motion=None, bounds=None):
+        now = time.time() if now is None else now
+        motion = motion if motion is not None else [None] * len(records)
+        if now - self.last_sweep >= self.sweep_interval:
+            self.sweep(now)
+
+        for record, kinematics in zip(records, motion):
+            hex_code = record["hex"]
+            if hex_code in self.aircraft:
+                self._remove(hex_code)
+            cell = self.cell(record["lat"], record["lon"])
+            self.aircraft[hex_code] = (record, cell, now, kinematics)
+            self.cells.setdefault(cell, set()).add(hex_code)
+
+        if radius is None:
+            return
+
+        seen = {record["hex"] for record in records}
+        for cell in self.covered_cells(lat, lon, radius):
+            if bounds is not None and not self._inside(cell, bounds):
+                continue
+            self.coverage[cell] = now
+            for hex_code in list(self.cells.get(cell, ())):
+                if hex_code not in seen:
+                    self._remove(hex_code)
+
+    def query(self, sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float, now=None):
+        now = time.time() if now is None else now
+        row_min, col_min, row_max, col_max = self.cell_range(sw_lat, sw_lon, ne_lat, ne_lon)
+
+        # Zoomed right out the box can span far more cells than are actually occupied
+        if (row_max - row_min + 1) * (col_max - col_min + 1) > len(self.cells):
+            cells = [cell for cell in self.cells
+                     if row_min <= cell[0] <= row_max and col_min <= cell[1] <= col_max]
+        else:
+            cells = [(row, col) for row in range(row_min, row_max + 1) for col in range(col_min, col_max + 1)]
+
+        results = []
+        expired = []
+        for cell in cells:
+            for hex_code in self.cells.get(cell, ()):
+                record, _, updated_at, _ = self.aircraft[hex_code]
+                if now - updated_at > self.expiry:
+                    expired.append(hex_code)
+                elif sw_lat <= record["lat"] <= ne_lat and sw_lon <= record["lon"] <= ne_lon:
+                    results.append(record)
+
+        for hex_code in expired:
+            self._remove(hex_code)
+
+        return results
+
+    # (ground speed, position time) for each record, NaN speed where we never had one
+    def motion(self, records):
+        motion = []
+        for record in records:
+            entry = self.aircraft.get(record["hex"])
+            kinematics = entry[3] if entry is not None else None
+            motion.append(kinematics if kinematics is not None else (math.nan, entry[2] if entry else math.nan))
+        return motion
@@ -0,0 +1,139 @@
+import time
+import asyncio
+import sqlite3
+import threading
+import traceback
+import sys
+from collections import OrderedDict
+
+from upstream import TokenBucket
+
+MISSING = object()
+
+
+# hex -> thumbnail URL, kept in SQLite so it survives restarts. A NULL image is a negative entry: we asked and the
+# airframe has no photo, which is cached too (for less time) so we don't keep asking. Every call blocks on SQLite, so
+# async code should run them in a thread. Sizes come from the table itself, as other workers may share the file.
+class ThumbnailCache:
+    def __init__(self, path: str, maxsize: int = 100000, ttl: float = 30 * 86400.0, negative_ttl: float = 3 * 86400.0):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.db = None
+        self.hits = 0
+        self.misses = 0
+
+    # Opened on first use so importing the service doesn't touch the disk
+    def _db(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS thumbnails ("
+                            "hex TEXT PRIMARY KEY, image TEXT, fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS thumbnails_accessed ON thumbnails (accessed_at)")
+        return self.db
+
+    def __len__(self):
+        with self.lock:
+            return self._db().execute("SELECT COUNT(*) FROM thumbnails").fetchone()[0]
+
+    def __contains__(self, hex_code):
+        return self.get(hex_code, touch=False) is not MISSING
+
+    def clear(self):
+        with self.lock:
+            self._db().execute("DELETE FROM thumbnails")
+
+    # Returns the image URL, None for a known negative, or MISSING if we need to ask upstream
+    def get(self, hex_code: str, touch: bool = True, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            db = self._db()
+            row = db.execute("SELECT image, fetched_at FROM thumbnails WHERE hex = ?", (hex_code,)).fetchone()
+            if row is None or now - row[1] > (self.ttl if row[0] is not None else self.negative_ttl):
+                if touch:
+                    self.misses += 1
+                return MISSING
+            if touch:
+                self.hits += 1
+                db.execute("UPDATE thumbnails SET accessed_at = ? WHERE hex = ?", (now, hex_code))
+            return row[0]
+
+    def put(self, hex_code: str, image, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            db = self._db()
+            db.execute("INSERT OR REPLACE INTO thumbnails (hex, image, fetched_at, accessed_at) VALUES (?, ?, ?, ?)",
+                       (hex_code, image, now, now))
+
+            # Least recently accessed go first once we're over size
+            excess = db.execute("SELECT COUNT(*) FROM thumbnails").fetchone()[0] - self.maxsize
+            if excess > 0:
+                db.execute("DELETE FROM thumbnails WHERE hex IN "
+                           "(SELECT hex FROM thumbnails ORDER BY accessed_at LIMIT ?)", (excess,))
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+# Background warm-up for hexes that have just shown up on someone's map. Only spends the thumbnail host's budget when
+# nobody is waiting on it interactively, and even then paces itself to its own (lower) rate so a third-party host
+# isn't hit flat out just because people are looking at a map.
+class ThumbnailPrefetcher:
+    def __init__(self, cache: ThumbnailCache, fetch, bucket, rate: float = 0.2, maxsize: int = 1000,
+                 interval: float = 0.5):
+        self.cache = cache
+        self.fetch = fetch
+        self.bucket = bucket
+        self.pace = TokenBucket(rate)
+        self.interval = interval
+        self.maxsize = maxsize
+        self.pending = OrderedDict()
+        self.task = None
+
+    def clear(self):
+        self.pending.clear()
+
+    def enqueue(self, hex_list):
+        for hex_code in hex_list:
+            if hex_code in self.pending:
+                continue
+            if len(self.pending) >= self.maxsize:
+                # Oldest sightings are least likely to be clicked on, so they make way
+                self.pending.popitem(last=False)
+            self.pending[hex_code] = None
+
+    async def run(self):
+        while True:
+            if not self.pending or self.bucket().waiting:
+                await asyncio.sleep(self.interval)
+                continue
+
+            hex_code, _ = self.pending.popitem(last=False)
+            if await asyncio.to_thread(self.cache.get, hex_code, touch=False) is not MISSING:
+                continue
+
+            await self.pace.acquire()
+            try:
+                await self.fetch(hex_code)
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+                await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
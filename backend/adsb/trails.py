@@ -0,0 +1,106 @@
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Bytes per stored point: float64 time, float32 lat, lon and altitude
+POINT_BYTES = 8 + 4 + 4 + 4
+
+
+# Recent positions for every aircraft we're tracking, in one preallocated slab of fixed-size ring buffers (a row per
+# aircraft) so memory is bounded up front no matter how busy it gets. When every row is taken, the aircraft we heard
+# from least recently gives its row up.
+class TrailStore:
+    def __init__(self, max_aircraft: int = 20000, points: int = 64):
+        self.max_aircraft = max_aircraft
+        self.points = points
+        self.slots = OrderedDict()  # hex -> row
+        self.free = list(range(max_aircraft - 1, -1, -1))
+        self.lock = threading.Lock()
+
+        self.time = np.full((max_aircraft, points), np.nan, dtype=np.float64)
+        self.lat = np.zeros((max_aircraft, points), dtype=np.float32)
+        self.lon = np.zeros((max_aircraft, points), dtype=np.float32)
+        self.alt = np.zeros((max_aircraft, points), dtype=np.float32)
+        self.head = np.zeros(max_aircraft, dtype=np.int32)  # next write position in each row
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, hex_code):
+        return hex_code in self.slots
+
+    def clear(self):
+        with self.lock:
+            self.slots.clear()
+            self.free = list(range(self.max_aircraft - 1, -1, -1))
+            self.time.fill(np.nan)
+            self.head.fill(0)
+
+    @property
+    def nbytes(self):
+        return self.time.nbytes + self.lat.nbytes + self.lon.nbytes + self.alt.nbytes + self.head.nbytes
+
+    def _slot(self, hex_code):
+        row = self.slots.get(hex_code)
+        if row is not None:
+            self.slots.move_to_end(hex_code)
+            return row
+
+        if self.free:
+            row = self.free.pop()
+        else:
+            _, row = self.slots.popitem(last=False)
+            self.time[row].fill(np.nan)
+            self.head[row] = 0
+
+        self.slots[hex_code] = row
+        return row
+
+    # One batch of positions, as parallel sequences. A point is only appended if it's newer than the aircraft's
+    # latest, so the same report arriving through overlapping responses isn't stored twice.
+    def ingest(self, hexes, lat, lon, alt, position_time):
+        if len(hexes) == 0:
+            return
+
+        with self.lock:
+            rows = np.array([self._slot(hex_code) for hex_code in hexes], dtype=np.int64)
+            position_time = np.asarray(position_time, dtype=np.float64)
+
+            latest = self.time[rows, (self.head[rows] - 1) % self.points]
+            newer = np.isnan(latest) | (position_time > latest)
+            rows = rows[newer]
+            heads = self.head[rows]
+
+            self.time[rows, heads] = position_time[newer]
+            self.lat[rows, heads] = np.asarray(lat, dtype=np.float32)[newer]
+            self.lon[rows, heads] = np.asarray(lon, dtype=np.float32)[newer]
+            self.alt[rows, heads] = np.asarray(alt, dtype=np.float32)[newer]
+            self.head[rows] = (heads + 1) % self.points
+
+    # Last n points for an aircraft, oldest first, as [time, lat, lon, alt] (alt None if unknown)
+    def trail(self, hex_code, n=None):
+        n = self.points if n is None else min(n, self.points)
+
+        with self.lock:
+            row = self.slots.get(hex_code)
+            if row is None:
+                return None
+            order = (self.head[row] - n + np.arange(n)) % self.points
+            time, lat, lon, alt = (self.time[row, order], self.lat[row, order], self.lon[row, order],
+                                   self.alt[row, order])
+
+        present = ~np.isnan(time)
+        return [[t, round(la, 6), round(lo, 6), None if math.isnan(al) else al]
+                for t, la, lo, al in zip(time[present].tolist(), lat[present].tolist(), lon[present].tolist(),
+                                         alt[present].tolist())]
+
+    def stats(self):
+        return {
+            "tracked": len(self.slots),
+            "capacity": self.max_aircraft,
+            "points_per_aircraft": self.points,
+            "bytes_per_aircraft": self.points * POINT_BYTES + self.head.itemsize,
+            "bytes_total": self.nbytes,
+        }
@@ -0,0 +1,83 @@
+import asyncio
+from urllib.parse import urlsplit
+
+import httpx
+
+
+# Classic token bucket, rate tokens per second up to capacity. Waiters queue on the lock so they're served in order.
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = None
+        self.waiting = 0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        if self.updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Rough time a new caller would spend queueing, given everyone already waiting ahead of it
+    def estimated_wait(self):
+        now = asyncio.get_event_loop().time()
+        tokens = self.tokens
+        if self.updated is not None:
+            tokens = min(self.capacity, tokens + (now - self.updated) * self.rate)
+        return max(0.0, (self.waiting + 1 - tokens) / self.rate)
+
+    async def acquire(self):
+        self.waiting += 1
+        try:
+            async with self.lock:
+                while True:
+                    now = asyncio.get_event_loop().time()
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+        finally:
+            self.waiting -= 1
+
+
+# One keep-alive connection pool shared by every upstream call, with an independent rate bucket per host so a slow
+# or strict host never holds up requests to another. bucket_factory(host, rate) swaps in another bucket
+# implementation, e.g. shared.RedisTokenBucket to share the limit across processes.
+class UpstreamClient:
+    def __init__(self, limits: dict, default_rate: float = 1.0, timeout: float = 10.0, max_connections: int = 20,
+                 transport=None, bucket_factory=None):
+        self.limits = limits
+        self.bucket_factory = bucket_factory or (lambda host, rate: TokenBucket(rate))
+        self.default_rate = default_rate
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.transport = transport
+        self.buckets = {}
+        self.client = None
+
+    def bucket(self, host: str):
+        if host not in self.buckets:
+            self.buckets[host] = self.bucket_factory(host, self.limits.get(host, self.default_rate))
+        return self.buckets[host]
+
+    # Created lazily so the client is bound to whichever event loop first uses it
+    def _client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                transport=self.transport,
+            )
+        return self.client
+
+    async def get(self, url: str):
+        await self.bucket(urlsplit(url).hostname).acquire()
+        return await self._client().get(url)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
@@ -1,6 +1,7 @@
 import base64
 import json
 import os
+import time
 
 from redis import asyncio as aioredis
 import httpx
@@ -46,12 +47,13 @@ async def get_summary(
         print("No aircraft data found.")
         return "There are no aircraft in the area."
 
-    image_url = f"http://mapping/?sw_lat={sw_lat}&sw_lon={sw_lon}&ne_lat={ne_lat}&ne_lon={ne_lon}"
+    # Cropped to the area and capped in size (small areas aren't blown up), the model doesn't need the full mosaic
+    image_url = f"http://mapping/?sw_lat={sw_lat}&sw_lon={sw_lon}&ne_lat={ne_lat}&ne_lon={ne_lon}&max_size=1024"
     image = await fetch_image(image_url)
 
     context = [
         {"role": "system", "content": "You are a Flight Radar summarisation agent. You will be provided with the image of a map (which does not include aircraft icons) and a JSON of all the aircraft in the area. You will be asked summary questions from the user about the image and the JSON. Note the location from the map, and what aircraft are in the area, and what they are doing. You should try use your aviation and military knowledge of the aircraft to try answer questions about what a given aircraft is likely to be doing given its situation and position."},
-        {"role": "system", "content": "You can use your get_aircraft_info tool in order to get more information about specific aircraft(s). You may only do this once per chat turn. Do not ask the user first, just use it as you see fit. Try to focus on specific aircraft rather than entering a huge amount of data."},
+        {"role": "system", "content": "You can use your get_aircraft_info tool in order to get more information about specific aircraft(s). You may only do this once per chat turn. Do not ask the user first, just use it as you see fit. Try to focus on specific aircraft rather than entering a huge amount of data. For questions about what happened in the area recently, use your get_area_history tool instead."},
         {"role": "system", "content": "Always refer to specific aircraft by their FLIGHT NAME, rather than their hex number. Never ask the user questions. Always provide direct, conclusive answers to the user. Always use tools if necessary."},
         {"role": "system", "content": str(aircraft)},
         {"role": "user", "content": question},
@@ -83,6 +85,19 @@ async def get_summary(
             "additionalProperties": False
         },
         "strict": True
+    }, {
+        "type": "function",
+        "name": "get_area_history",
+        "description": "Get the positions reported by aircraft in the area over the last few minutes (up to 60), oldest first. Busy areas are cut down to the most recent 2000 positions. Use this for questions about what has happened here recently.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "minutes": {"type": "integer", "description": "How many minutes back to look, at most 60."},
+            },
+            "required": ["minutes"],
+            "additionalProperties": False
+        },
+        "strict": True
     }]
 
     response = await client.responses.create(
@@ -92,13 +107,18 @@ async def get_summary(
     )
 
     if response.output[0].type == "function_call":
-        # We only have one available function right now, so no need to check which one it is
         tool_call = response.output[0]
         args = json.loads(tool_call.arguments)
-        hex_number = args["hex"]
 
-        hex_url = f"http://adsb/hex?hex={hex_number}"
-        aircraft_info = await fetch_json(hex_url)
+        if tool_call.name == "get_area_history":
+            end = time.time()
+            start = end - min(max(int(args["minutes"]), 1), 60) * 60
+            history_url = f"http://adsb/history?sw_lat={sw_lat}&sw_lon={sw_lon}&ne_lat={ne_lat}&ne_lon={ne_lon}" \
+                          f"&start={start}&end={end}&limit=2000&newest=true"
+            aircraft_info = await fetch_json(history_url)
+        else:
+            hex_url = f"http://adsb/hex?hex={args['hex']}"
+            aircraft_info = await fetch_json(hex_url)
 
         context.append(tool_call)
         context.append({
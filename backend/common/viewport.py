@@ -0,0 +1,73 @@
+import math
+
+# Shared by the adsb and mapping services (copied into each image at build time). Viewports are snapped outwards onto
+# the slippy map tile grid, so nearby pans and zooms land on the same key and can share cached and upstream results.
+# Only the final response is cut back down to the exact bbox that was asked for.
+
+# Web Mercator can't go any closer to the poles than this
+MAX_LATITUDE = 85.05112878
+
+
+# Borrowed from https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
+def deg2num(lat_deg, lon_deg, zoom):
+    lat_rad = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat_deg)))
+    n = 1 << zoom
+    xtile = int((lon_deg + 180.0) / 360.0 * n)
+    ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(xtile, 0), n - 1), min(max(ytile, 0), n - 1)
+
+
+# Borrowed from https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
+def num2deg(xtile, ytile, zoom):
+    n = 1 << zoom
+    lon_deg = xtile / n * 360.0 - 180.0
+    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
+    lat_deg = math.degrees(lat_rad)
+    return lat_deg, lon_deg
+
+
+def calculate_zoom(sw, ne, target_width=1):
+    lon_diff = ne[1] - sw[1]
+
+    # Original equation from https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
+    # Re-arranging from: target_width = (lon_diff / 360) * 2^zoom
+    zoom_float = math.log2((target_width * 360) / lon_diff)
+
+    # Round to the nearest integer zoom level
+    zoom = int(round(zoom_float))
+    return zoom
+
+
+# Tiles (start_x, start_y, end_x, end_y) covering the box, y counting down from the north
+def tile_range(sw, ne, zoom):
+    (start_x, end_y) = deg2num(sw[0], sw[1], zoom)
+    (end_x, start_y) = deg2num(ne[0], ne[1], zoom)
+    return start_x, start_y, end_x, end_y
+
+
+# (sw, ne) corners of a tile range
+def tile_bounds(start_x, start_y, end_x, end_y, zoom):
+    sw = num2deg(start_x, end_y + 1, zoom)
+    ne = num2deg(end_x + 1, start_y, zoom)
+    return sw, ne
+
+
+# Coarsest zoom whose tiles are still at least as wide as the viewport, so any viewport snaps to at most 2x2 tiles
+# across, capped at max_zoom so tiny viewports all share the same cells
+def grid_zoom(sw, ne, max_zoom: int = 11):
+    lon_diff = max(ne[1] - sw[1], 1e-9)
+    return max(0, min(max_zoom, int(math.floor(math.log2(360 / lon_diff)))))
+
+
+# Quantized key (zoom, start_x, start_y, end_x, end_y) and the snapped bbox it stands for, as
+# (sw_lat, sw_lon, ne_lat, ne_lon)
+def quantize_bbox(sw_lat: float, sw_lon: float, ne_lat: float, ne_lon: float, zoom=None, max_zoom: int = 11):
+    sw, ne = (sw_lat, sw_lon), (ne_lat, ne_lon)
+    zoom = grid_zoom(sw, ne, max_zoom) if zoom is None else zoom
+    tiles = tile_range(sw, ne, zoom)
+    (snapped_sw, snapped_ne) = tile_bounds(*tiles, zoom)
+
+    # The tile grid stops short of the poles, so stretch to them rather than leave a strip uncovered
+    snapped_sw_lat = -90.0 if sw_lat < -MAX_LATITUDE else snapped_sw[0]
+    snapped_ne_lat = 90.0 if ne_lat > MAX_LATITUDE else snapped_ne[0]
+    return (zoom, *tiles), (snapped_sw_lat, snapped_sw[1], snapped_ne_lat, snapped_ne[1])
@@ -0,0 +1,135 @@
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Worth another go: the tile server being overloaded or briefly unavailable
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+# The caller's deadline (or the wait for a free slot) ran out before the tile server gave a definite answer, which
+# says nothing about the tile itself
+class OutOfTime(Exception):
+    pass
+
+
+# One keep-alive connection pool for every tile request the service makes, so tiles reuse TLS connections to the
+# tile server instead of handshaking for each one. At most max_concurrency requests are in flight at once across all
+# callers, failures are retried with exponential backoff, and nothing runs past the caller's deadline.
+class TileFetcher:
+    def __init__(self, max_connections: int = 32, max_concurrency: int = 16, timeout: float = 5.0, retries: int = 2,
+                 backoff: float = 0.25):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    # Body of a 200 response, or None if the tile server refused it or retries ran out. Raises OutOfTime if the
+    # deadline (time.monotonic()) comes first.
+    def fetch(self, url: str, deadline=None):
+        for attempt in range(self.retries + 1):
+            remaining = self.timeout if deadline is None else min(self.timeout, deadline - time.monotonic())
+            if remaining <= 0 or not self.slots.acquire(timeout=remaining):
+                print(f"Gave up on {url.split('?')[0]}, out of time")
+                raise OutOfTime(url.split('?')[0])
+
+            try:
+                remaining = self.timeout if deadline is None else min(self.timeout, deadline - time.monotonic())
+                response = self.session.get(url, timeout=max(remaining, 0.001))
+                if response.status_code == 200:
+                    return response.content
+                if response.status_code not in RETRY_STATUSES:
+                    print(f"Failed to fetch {url.split('?')[0]}, status code: {response.status_code}")
+                    return None
+                reason = f"status code {response.status_code}"
+            except requests.RequestException as e:
+                reason = str(e)
+            finally:
+                self.slots.release()
+
+            delay = self.backoff * (2 ** attempt)
+            if attempt == self.retries:
+                print(f"Failed to fetch {url.split('?')[0]} after {attempt + 1} attempts: {reason}")
+                return None
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                print(f"Gave up on {url.split('?')[0]} after {attempt + 1} attempts, out of time: {reason}")
+                raise OutOfTime(url.split('?')[0])
+            time.sleep(delay)
+
+    def close(self):
+        self.session.close()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+# Single-flight for tile misses: whoever misses a key first fetches it, anyone else missing the same key meanwhile
+# waits for that result instead of downloading it again. A failed fetch is remembered for negative_ttl seconds, and
+# asking again inside that just gets None straight back, so one broken tile can't set off a storm of retries. A fetch
+# that raises (e.g. OutOfTime) isn't remembered: the exception goes to whoever was fetching and any waiters get None.
+class SingleFlight:
+    def __init__(self, negative_ttl: float = 30.0, max_failures: int = 10000):
+        self.negative_ttl = negative_ttl
+        self.max_failures = max_failures
+        self.lock = threading.Lock()
+        self.flights = {}   # key -> _Flight
+        self.failures = {}  # key -> failed at
+        self.shared = 0
+        self.negative_hits = 0
+
+    def clear(self):
+        with self.lock:
+            self.failures.clear()
+
+    # fetch() returns the value or None on failure. Waiters give up (with None) after timeout seconds.
+    def do(self, key, fetch, timeout=None):
+        with self.lock:
+            failed_at = self.failures.get(key)
+            if failed_at is not None:
+                if time.monotonic() - failed_at < self.negative_ttl:
+                    self.negative_hits += 1
+                    return None
+                del self.failures[key]
+
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+            else:
+                self.shared += 1
+
+        if not leader:
+            flight.done.wait(timeout)
+            return flight.result
+
+        failed = False
+        try:
+            flight.result = fetch()
+            failed = flight.result is None
+        finally:
+            with self.lock:
+                del self.flights[key]
+                if failed:
+                    self._fail(key)
+            flight.done.set()
+        return flight.result
+
+    def _fail(self, key):
+        now = time.monotonic()
+        if len(self.failures) >= self.max_failures:
+            self.failures = {k: t for k, t in self.failures.items() if now - t < self.negative_ttl}
+        self.failures[key] = now
+
+    def stats(self):
+        with self.lock:
+            return {"in_flight": len(self.flights), "shared": self.shared, "negative_hits": self.negative_hits,
+                    "failures": len(self.failures)}
@@ -1,25 +1,45 @@
 import os
 import io
+import time
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, Query, HTTPException
 from fastapi.responses import Response
 
-from osm_stitcher import get_map, get_tile
+from osm_stitcher import get_map, crop_map, get_tile_bytes, tiles, fetcher, executor, flights, mosaics
 
 OSM_API_KEY = os.getenv("OSM_API_KEY")
 
-app = FastAPI(root_path="/map")
+# Seconds a /map/ request waits for its tiles before sending what it has, and a /tile request before giving up
+MAP_DEADLINE = float(os.getenv("MAPPING_MAP_DEADLINE", "10.0"))
+TILE_DEADLINE = float(os.getenv("MAPPING_TILE_DEADLINE", "5.0"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    executor.shutdown(wait=False, cancel_futures=True)
+    fetcher.close()
+    tiles.close()
+
+
+app = FastAPI(root_path="/map", lifespan=lifespan)
 
 
 @app.get("/")
 # Async is NOT used here, as this ensures the function is offloaded to a separate thread due to the blocking nature
 # of this relatively slow and I/O-bound function.
 def fetch_map(sw_lat: float = Query(...), sw_lon: float = Query(...),
-                        ne_lat: float = Query(...), ne_lon: float = Query(...)):
+                        ne_lat: float = Query(...), ne_lon: float = Query(...),
+                        width: int = Query(None, ge=1, le=4096), height: int = Query(None, ge=1, le=4096),
+                        max_size: int = Query(None, ge=1, le=4096)):
 
     sw = (sw_lat, sw_lon)
     ne = (ne_lat, ne_lon)
-    img, (sw_new, ne_new) = get_map(sw, ne, API_KEY=OSM_API_KEY)
+    img, extent = get_map(sw, ne, API_KEY=OSM_API_KEY, deadline=MAP_DEADLINE)
+
+    # Just the box that was asked for, at the size asked for, rather than every whole tile it touches
+    img, (sw_new, ne_new) = crop_map(img, extent, sw, ne, width=width, height=height, max_size=max_size)
 
     img_byte_array = io.BytesIO()
     img.save(img_byte_array, format='PNG')
@@ -31,13 +51,17 @@ def fetch_map(sw_lat: float = Query(...), sw_lon: float = Query(...),
 
 @app.get("/tile")
 def fetch_tile(x: int = Query(...), y: int = Query(...), zoom: int = Query(...)):
-    img = get_tile(x, y, zoom, API_KEY=OSM_API_KEY)
+    # Sent exactly as the tile server encoded it, no decode or re-encode on the way through
+    data = get_tile_bytes(x, y, zoom, API_KEY=OSM_API_KEY, deadline=time.monotonic() + TILE_DEADLINE)
+    if data is None:
+        raise HTTPException(status_code=502, detail="Failed to fetch tile.")
+
+    return Response(content=data, media_type="image/png")
 
-    img_byte_array = io.BytesIO()
-    img.save(img_byte_array, format='PNG')
-    img_byte_array.seek(0)
 
-    return Response(content=img_byte_array.getvalue(), media_type="image/png")
+@app.get("/stats")
+def fetch_stats():
+    return {"tiles": tiles.stats(), "fetches": flights.stats(), "mosaics": mosaics.stats()}
 
 
 if __name__ == "__main__":
@@ -1,100 +1,168 @@
+import os
 import math
-import threading
-from concurrent.futures import ThreadPoolExecutor
-from cachetools import LRUCache
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
-import requests
 from io import BytesIO
 from PIL import Image
 
-# Need to debug, but this should come under 16GB of RAM so plenty fine
-# Using cachetools implementation for thread-safe LRU cache, as multiple clients could be requesting the same tile
-cache = LRUCache(maxsize=16000)
-cache_lock = threading.Lock()
+from viewport import calculate_zoom, tile_range, tile_bounds
+from tilestore import TileStore, MosaicCache
+from fetcher import TileFetcher, SingleFlight, OutOfTime
 
+# Anything kept across restarts lives here, mount a volume over it in production
+DATA_DIR = os.getenv("MAPPING_DATA_DIR", ".")
 
-# Borrowed from https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
-def deg2num(lat_deg, lon_deg, zoom):
-    lat_rad = math.radians(lat_deg)
-    n = 1 << zoom
-    xtile = int((lon_deg + 180.0) / 360.0 * n)
-    ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
-    return xtile, ytile
+# Tiles are kept as the original PNG bytes, on disk (so a restart starts warm) and the hottest in memory, both capped
+# in MB rather than tile count
+TILE_MEMORY_MB = int(os.getenv("MAPPING_TILE_MEMORY_MB", "256"))
+TILE_DISK_MB = int(os.getenv("MAPPING_TILE_DISK_MB", "4096"))
 
+# Tile server connections: pool size, most requests in flight at once, per-attempt timeout and retries (seconds), and
+# the worker threads get_map fans tiles out over, shared by every map request rather than spun up per call
+FETCH_CONNECTIONS = int(os.getenv("MAPPING_FETCH_CONNECTIONS", "32"))
+FETCH_CONCURRENCY = int(os.getenv("MAPPING_FETCH_CONCURRENCY", "16"))
+FETCH_TIMEOUT = float(os.getenv("MAPPING_FETCH_TIMEOUT", "5.0"))
+FETCH_RETRIES = int(os.getenv("MAPPING_FETCH_RETRIES", "2"))
+FETCH_WORKERS = int(os.getenv("MAPPING_FETCH_WORKERS", "32"))
 
-# Borrowed from https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
-def num2deg(xtile, ytile, zoom):
-    n = 1 << zoom
-    lon_deg = xtile / n * 360.0 - 180.0
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
-    lat_deg = math.degrees(lat_rad)
-    return lat_deg, lon_deg
+# Seconds a tile that failed to download is left alone before anyone tries it again
+TILE_NEGATIVE_TTL = float(os.getenv("MAPPING_TILE_NEGATIVE_TTL", "30.0"))
 
+# Stitched mosaics kept decoded for reuse by later requests over the same tiles, capped in MB
+MOSAIC_MEMORY_MB = int(os.getenv("MAPPING_MOSAIC_MEMORY_MB", "512"))
 
-def calculate_zoom(sw, ne, target_width=1):
-    lon_diff = ne[1] - sw[1]
+tiles = TileStore(os.path.join(DATA_DIR, "tiles.mbtiles"), memory_bytes=TILE_MEMORY_MB * 1024 ** 2,
+                  disk_bytes=TILE_DISK_MB * 1024 ** 2)
+fetcher = TileFetcher(max_connections=FETCH_CONNECTIONS, max_concurrency=FETCH_CONCURRENCY, timeout=FETCH_TIMEOUT,
+                      retries=FETCH_RETRIES)
+executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="tiles")
+flights = SingleFlight(negative_ttl=TILE_NEGATIVE_TTL)
+mosaics = MosaicCache(max_bytes=MOSAIC_MEMORY_MB * 1024 ** 2)
 
-    # Original equation from https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
-    # Re-arranging from: target_width = (lon_diff / 360) * 2^zoom
-    zoom_float = math.log2((target_width * 360) / lon_diff)
 
-    # Round to the nearest integer zoom level
-    zoom = int(round(zoom_float))
-    return zoom
+# Original PNG bytes, straight from the store where we have them. Nothing is decoded here, /tile sends these as-is.
+# deadline is a time.monotonic() value, past which we stop trying
+def get_tile_bytes(x, y, zoom, API_KEY=None, deadline=None):
 
+    assert API_KEY is not None, "Tracestack API_KEY must be provided to fetch tiles!"
 
-def get_tile(x, y, zoom, API_KEY=None):
+    data = tiles.get((zoom, x, y))
+    if data is not None:
+        return data
+
+    def fetch():
+        # Someone else's flight may have landed between our miss and this one taking off
+        cached = tiles.get((zoom, x, y), count=False)
+        if cached is not None:
+            return cached
+
+        fetched = fetcher.fetch(f"https://tile.tracestrack.com/_/{zoom}/{x}/{y}.png?key={API_KEY}", deadline=deadline)
+        if fetched is not None:
+            tiles.put((zoom, x, y), fetched)
+        return fetched
+
+    # Concurrent misses on the same tile (overlapping maps, or /tile and /map/ together) share one download. Running
+    # out of time isn't the tile's fault, so that's just None for now rather than a remembered failure.
+    timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+    try:
+        return flights.do((zoom, x, y), fetch, timeout=timeout)
+    except OutOfTime:
+        return None
 
-    assert API_KEY is not None, "Tracestack API_KEY must be provided to fetch tiles!"
 
-    with cache_lock:
-        if (zoom, x, y) in cache:
-            return cache[(zoom, x, y)]
+# Decoded, for compositing in get_map. Loaded here so the worker thread pays for the decode, not the caller.
+def get_tile(x, y, zoom, API_KEY=None, deadline=None):
+    data = get_tile_bytes(x, y, zoom, API_KEY=API_KEY, deadline=deadline)
+    if data is None:
+        return None
+    img = Image.open(BytesIO(data))
+    img.load()
+    return img
 
-    url = f"https://tile.tracestrack.com/_/{zoom}/{x}/{y}.png?key={API_KEY}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        img = Image.open(BytesIO(response.content))
 
-        with cache_lock:
-            cache[(zoom, x, y)] = img
+# Tiles still missing at the deadline (seconds from now) are left blank rather than holding the whole map up. The
+# returned image may be shared with other requests through the mosaic cache, so don't draw on it.
+def get_map(sw, ne, zoom=None, tile_size=512, API_KEY=None, deadline=10.0):
 
-        return img
+    assert API_KEY is not None, "Tracestack API_KEY must be provided to fetch tiles!"
 
-    else:
-        print(f"Failed to fetch tile {zoom}/{x}/{y}, status code: {response.status_code}")
-        return None
+    # Some elements from https://stackoverflow.com/questions/28476117/easy-openstreetmap-tile-displaying-for-python
+    zoom = calculate_zoom(sw, ne) if zoom is None else zoom
+    (start_x, start_y, end_x, end_y) = tile_range(sw, ne, zoom)
+    extent = tile_bounds(start_x, start_y, end_x, end_y, zoom)
 
+    key = (zoom, start_x, start_y, end_x, end_y, tile_size)
+    map_img = mosaics.get(key)
+    if map_img is not None:
+        return map_img, extent
 
-def get_map(sw, ne, zoom=None, tile_size=512, API_KEY=None):
+    map_img = Image.new('RGB', ((end_x - start_x + 1) * tile_size, (end_y - start_y + 1) * tile_size))
 
-    assert API_KEY is not None, "Tracestack API_KEY must be provided to fetch tiles!"
+    # Fetched and decoded on the shared workers, but only ever pasted from this thread
+    until = time.monotonic() + deadline
+    futures = {executor.submit(get_tile, x, y, zoom, API_KEY, until): (x, y)
+               for x in range(start_x, end_x + 1) for y in range(start_y, end_y + 1)}
+    done, _ = wait(futures, timeout=deadline)
 
-    # Experimental, as PIL isn't known thread-safe, but it appears to work as there is no overlap
-    def add_tile(x, y):
-        nonlocal zoom, start_x, start_y, API_KEY  # Only for explicitness
-        tile = get_tile(x, y, zoom, API_KEY=API_KEY)
+    complete = True
+    for future, (x, y) in futures.items():
+        tile = future.result() if future in done else None
         if tile is not None:
             map_img.paste(tile, ((x - start_x) * tile_size, (y - start_y) * tile_size))
         else:
+            complete = False
             print(f"Failed to fetch tile {zoom}/{x}/{y}")
 
-    # Some elements from https://stackoverflow.com/questions/28476117/easy-openstreetmap-tile-displaying-for-python
-    zoom = calculate_zoom(sw, ne) if zoom is None else zoom
-    (start_x, end_y) = deg2num(sw[0], sw[1], zoom)
-    (end_x, start_y) = deg2num(ne[0], ne[1], zoom)
+    # Only whole mosaics are kept, a blank gap shouldn't outlive the tile that caused it
+    if complete:
+        mosaics.put(key, map_img)
 
-    map_img = Image.new('RGB', ((end_x - start_x + 1) * tile_size, (end_y - start_y + 1) * tile_size))
+    return map_img, extent
+
+
+def _mercator_y(lat):
+    return math.asinh(math.tan(math.radians(lat)))
+
+
+# Cuts a tile-aligned map from get_map down to just the sw/ne box, then scales it to width x height pixels (keeping
+# the aspect ratio if only one is given). Returns the new image and the extent it actually covers, which can be a
+# fraction of a pixel off the box asked for.
+def crop_map(img, extent, sw, ne, width=None, height=None, max_size=None):
+    (ext_sw, ext_ne) = extent
+    x_scale = img.width / (ext_ne[1] - ext_sw[1])
+    top = _mercator_y(ext_ne[0])
+    y_scale = img.height / (top - _mercator_y(ext_sw[0]))
+
+    left = max(0, math.floor((sw[1] - ext_sw[1]) * x_scale))
+    right = min(img.width, max(left + 1, math.ceil((ne[1] - ext_sw[1]) * x_scale)))
+    upper = max(0, math.floor((top - _mercator_y(ne[0])) * y_scale))
+    lower = min(img.height, max(upper + 1, math.ceil((top - _mercator_y(sw[0])) * y_scale)))
+
+    # Edges left where they were keep their exact coordinates rather than a round trip through pixels
+    def lat_at(y, edge):
+        return edge if y in (0, img.height) else math.degrees(math.atan(math.sinh(top - y / y_scale)))
+
+    def lon_at(x, edge):
+        return edge if x in (0, img.width) else ext_sw[1] + x / x_scale
 
-    required_tiles = [(x, y) for x in range(start_x, end_x + 1) for y in range(start_y, end_y + 1)]
+    cropped_extent = ((lat_at(lower, ext_sw[0]), lon_at(left, ext_sw[1])),
+                      (lat_at(upper, ext_ne[0]), lon_at(right, ext_ne[1])))
+    cropped = img.crop((left, upper, right, lower))
 
-    with ThreadPoolExecutor(max_workers=32) as executor:
-        executor.map(lambda args: add_tile(*args), required_tiles)
+    if width is not None or height is not None:
+        width = width or max(1, round(cropped.width * height / cropped.height))
+        height = height or max(1, round(cropped.height * width / cropped.width))
+        if (width, height) != cropped.size:
+            cropped = cropped.resize((width, height), Image.BILINEAR)
 
-    sw_new = num2deg(start_x, start_y, zoom)
-    ne_new = num2deg(end_x + 1, end_y + 1, zoom)
+    # Unlike width/height, only ever shrinks the longest side down to max_size, keeping the aspect ratio
+    if max_size is not None and max(cropped.size) > max_size:
+        scale = max_size / max(cropped.size)
+        cropped = cropped.resize((max(1, round(cropped.width * scale)), max(1, round(cropped.height * scale))),
+                                 Image.BILINEAR)
 
-    return map_img, (sw_new, ne_new)
+    return cropped, cropped_extent
 
 
 if __name__ == "__main__":
@@ -102,5 +170,6 @@ if __name__ == "__main__":
     ne = (53.230539, -0.542218)
     resolution = (1920, 1080)
 
-    composite_img, extent = get_map(sw, ne)
+    composite_img, extent = get_map(sw, ne, API_KEY=os.getenv("OSM_API_KEY"))
+    composite_img, extent = crop_map(composite_img, extent, sw, ne, *resolution)
     composite_img.save("composite_map.png")
@@ -0,0 +1,192 @@
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+# Tile bytes exactly as the tile server sent them, in an MBTiles-style SQLite file so a restart starts warm, with the
+# most recently used ones also held in memory. Both tiers are bounded by bytes rather than tile count, as tile sizes
+# vary by an order of magnitude between open sea and a city centre.
+class TileStore:
+    def __init__(self, path: str, memory_bytes: int = 256 * 1024 ** 2, disk_bytes: int = 4 * 1024 ** 3):
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+        self.db = None
+
+        self.hot = OrderedDict()  # (zoom, x, y) -> bytes
+        self.hot_size = 0
+        self.disk_count = 0
+        self.disk_size = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Opened on first use so importing the service doesn't touch the disk. Rows are stored the MBTiles way round (TMS,
+    # y counting up from the south) so the file opens in other tools.
+    def _db(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("INSERT OR IGNORE INTO metadata (name, value) VALUES ('format', 'png')")
+            self.db.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, "
+                            "tile_row INTEGER, tile_data BLOB NOT NULL, accessed_at REAL NOT NULL, "
+                            "PRIMARY KEY (zoom_level, tile_column, tile_row))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed_at)")
+            self.disk_count, self.disk_size = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles").fetchone()
+        return self.db
+
+    @staticmethod
+    def _row(key):
+        zoom, x, y = key
+        return zoom, x, (1 << zoom) - 1 - y
+
+    def _remember(self, key, data):
+        previous = self.hot.pop(key, None)
+        if previous is not None:
+            self.hot_size -= len(previous)
+        self.hot[key] = data
+        self.hot_size += len(data)
+        while self.hot_size > self.memory_bytes and self.hot:
+            _, evicted = self.hot.popitem(last=False)
+            self.hot_size -= len(evicted)
+
+    # count=False for a second look that shouldn't show up in the hit/miss stats
+    def get(self, key, now=None, count: bool = True):
+        with self.lock:
+            data = self.hot.get(key)
+            if data is not None:
+                self.hot.move_to_end(key)
+                self.memory_hits += count
+                return data
+
+            db = self._db()
+            row = db.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                             self._row(key)).fetchone()
+            if row is None:
+                self.misses += count
+                return None
+
+            # Only touched when it comes up from disk, memory hits never write
+            self.disk_hits += count
+            db.execute("UPDATE tiles SET accessed_at = ? WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                       (time.time() if now is None else now, *self._row(key)))
+            data = bytes(row[0])
+            self._remember(key, data)
+            return data
+
+    def put(self, key, data: bytes, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self._remember(key, data)
+
+            db = self._db()
+            previous = db.execute("SELECT LENGTH(tile_data) FROM tiles WHERE zoom_level = ? AND tile_column = ? "
+                                  "AND tile_row = ?", self._row(key)).fetchone()
+            if previous is None:
+                self.disk_count += 1
+            else:
+                self.disk_size -= previous[0]
+            db.execute("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, accessed_at) "
+                       "VALUES (?, ?, ?, ?, ?)", (*self._row(key), sqlite3.Binary(data), now))
+            self.disk_size += len(data)
+
+            if self.disk_size > self.disk_bytes:
+                self._evict(db)
+
+    # Least recently used first, down to 90% so we aren't back in here on the very next put
+    def _evict(self, db):
+        target = self.disk_bytes * 0.9
+        while self.disk_size > target and self.disk_count:
+            rows = db.execute("SELECT zoom_level, tile_column, tile_row, LENGTH(tile_data) FROM tiles "
+                              "ORDER BY accessed_at LIMIT 256").fetchall()
+            if not rows:
+                break
+            for zoom, column, row, size in rows:
+                db.execute("DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                           (zoom, column, row))
+                self.disk_size -= size
+                self.disk_count -= 1
+                self.evictions += 1
+                if self.disk_size <= target:
+                    break
+
+    def stats(self):
+        with self.lock:
+            self._db()
+            return {
+                "memory": {"entries": len(self.hot), "bytes": self.hot_size, "limit": self.memory_bytes},
+                "disk": {"entries": self.disk_count, "bytes": self.disk_size, "limit": self.disk_bytes},
+                "hits": {"memory": self.memory_hits, "disk": self.disk_hits},
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.hot.clear()
+            self.hot_size = 0
+            self._db().execute("DELETE FROM tiles")
+            self.disk_count = self.disk_size = 0
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+# Stitched map mosaics (decoded images) keyed by zoom and tile range, so repeated and overlapping viewports that land
+# on the same tiles skip the stitch. Bounded by decoded size in bytes.
+class MosaicCache:
+    def __init__(self, max_bytes: int = 512 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> image
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _sizeof(img):
+        return img.width * img.height * len(img.getbands())
+
+    def get(self, key):
+        with self.lock:
+            img = self.entries.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return img
+
+    # Callers must treat cached images as read-only, they're shared
+    def put(self, key, img):
+        size = self._sizeof(img)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= self._sizeof(previous)
+            self.entries[key] = img
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self._sizeof(evicted)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "limit": self.max_bytes, "hits": self.hits,
+                    "misses": self.misses}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
@@ -1,13 +1,48 @@
+import asyncio
+import copy
+import math
+import tempfile
+import time
+
+import httpx
+import numpy as np
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 from httpx import AsyncClient, ASGITransport
 
 # Does not work without this
 import sys
 import os
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(project_root)
+sys.path.insert(0, os.path.join(project_root, "backend", "adsb"))
+sys.path.insert(0, os.path.join(project_root, "backend", "common"))
+
+# Keep anything the service persists out of the working tree
+os.environ.setdefault("ADSB_DATA_DIR", tempfile.mkdtemp())
 
-from backend.adsb.main import app
+from backend.adsb.main import app, radius_coalescer, spatial_index, poller, hex_cache, thumbnail_cache, \
+    thumbnail_prefetcher, snapshots, trails, hex_batcher
+from upstream import UpstreamClient, TokenBucket
+from thumbnails import ThumbnailCache, ThumbnailPrefetcher
+import columnar
+from normalize import normalise, normalise_columns
+from kinematics import extrapolate
+from trails import TrailStore
+from batching import HexBatcher
+from hexcache import HexCache
+from shared import RedisHexStore, RedisTokenBucket
+from fakeredis import aioredis as fakeredis
+from redis.exceptions import ConnectionError as RedisConnectionError
+from recording import Recorder, Replayer
+from viewport import quantize_bbox
+from spatial import SpatialIndex
+from planner import QueryPlanner, MAX_RADIUS_NM
+from aggregate import clusters, density_grid
+from registry import AircraftRegistry, build, read_dump
+from history import HistoryStore
+from delta import SnapshotStore
+import backend.adsb.main as adsb_main
 from examples.airplanes_live import POINT, HEX_SINGLE, HEX_MULTIPLE
 
 
@@ -17,6 +52,22 @@ def get_client():
     return AsyncClient(transport=transport, base_url="http://test")
 
 
+# Module-level caches would otherwise leak upstream results between tests
+@pytest.fixture(autouse=True)
+def reset_state():
+    radius_coalescer.clear()
+    spatial_index.clear()
+    poller.clear()
+    hex_cache.clear()
+    thumbnail_cache.clear()
+    thumbnail_prefetcher.clear()
+    snapshots.clear()
+    trails.clear()
+    hex_batcher.clear()
+    adsb_main.history.clear()
+    yield
+
+
 @pytest.mark.asyncio
 @patch("backend.adsb.main.adsb_request")
 async def test_radius(mock_get):
@@ -26,11 +77,12 @@ async def test_radius(mock_get):
     mock_get.return_value = mock_response
 
     async with get_client() as ac:
+        # Boxed around the example aircraft's last position, as results are clipped to the exact bbox
         response = await ac.get("/radius", params={
-            "sw_lat": 53.15,
-            "sw_lon": -0.64,
-            "ne_lat": 53.26,
-            "ne_lon": -0.46
+            "sw_lat": 43.2,
+            "sw_lon": 29.55,
+            "ne_lat": 43.3,
+            "ne_lon": 29.7
         })
         assert response.status_code == 200
         data = response.json()
@@ -38,6 +90,196 @@ async def test_radius(mock_get):
         assert len(data["ac"]) == 1
 
 
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_radius_from_index(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = POINT
+    mock_get.return_value = mock_response
+
+    async with get_client() as ac:
+        await ac.get("/radius", params={"sw_lat": 43.2, "sw_lon": 29.55, "ne_lat": 43.3, "ne_lon": 29.7})
+
+        # Inside the cells that were just refreshed, so answered without going back upstream
+        inside = await ac.get("/radius", params={"sw_lat": 43.25, "sw_lon": 29.6, "ne_lat": 43.27, "ne_lon": 29.65})
+        outside = await ac.get("/radius", params={"sw_lat": 43.22, "sw_lon": 29.56, "ne_lat": 43.24, "ne_lon": 29.58})
+
+        assert mock_get.call_count == 1
+        assert len(inside.json()["ac"]) == 1
+        assert len(outside.json()["ac"]) == 0
+
+
+def test_quantize_bbox():
+    key, snapped = quantize_bbox(43.2, 29.55, 43.3, 29.7)
+    panned, _ = quantize_bbox(43.21, 29.56, 43.31, 29.7)
+    assert key == panned
+
+    # Always grows outwards, never cuts into the viewport
+    assert snapped[0] <= 43.2 and snapped[1] <= 29.55 and snapped[2] >= 43.3 and snapped[3] >= 29.7
+
+    # Past the edge of the tile grid it stretches to the pole
+    _, polar = quantize_bbox(80.0, 10.0, 89.0, 20.0)
+    assert polar[2] == 90.0
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_radius_panned(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = POINT
+    mock_get.return_value = mock_response
+
+    async with get_client() as ac:
+        first = await ac.get("/radius", params={"sw_lat": 43.2, "sw_lon": 29.55, "ne_lat": 43.3, "ne_lon": 29.7})
+
+        # Nudged past the edge of the original box, but still inside the same snapped tiles
+        panned = await ac.get("/radius", params={"sw_lat": 43.22, "sw_lon": 29.56, "ne_lat": 43.32, "ne_lon": 29.7})
+
+        assert mock_get.call_count == 1
+        assert first.json()["ac"] == panned.json()["ac"]
+
+        # Only the request that actually went upstream has a plan to report
+        assert first.headers["X-Query-Plan"] == "1x1"
+        assert "X-Query-Plan" not in panned.headers
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_radius_antimeridian(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {"ac": [{"hex": "c81234", "lat": -41.3, "lon": 174.8, "track": 90.0}]}
+    mock_get.return_value = mock_response
+
+    # Snaps onto the easternmost tile column, which ends exactly on the antimeridian
+    async with get_client() as ac:
+        response = await ac.get("/radius", params={"sw_lat": -48.0, "sw_lon": 165.0, "ne_lat": -34.0, "ne_lon": 179.5})
+
+        assert response.status_code == 200
+        assert [a["hex"] for a in response.json()["ac"]] == ["c81234"]
+
+
+def test_stale_bounds():
+    index = SpatialIndex()
+    now = 1000.0
+
+    # Southern half of a one degree box covered, so only the northern half needs fetching
+    index.coverage.update({(row, col): now for row in range(500, 505) for col in range(0, 10)})
+    assert index.stale_bounds(50.0, 0.0, 50.99, 0.99, max_age=10, now=now) == pytest.approx((50.5, 0.0, 51.0, 1.0))
+    assert index.stale_bounds(50.0, 0.0, 50.49, 0.99, max_age=10, now=now) is None
+    assert index.stale_bounds(50.0, 0.0, 50.49, 0.99, max_age=10, now=now + 20) == pytest.approx((50.0, 0.0, 50.5, 1.0))
+    assert index.coverage_age(50.0, 0.0, 50.49, 0.99, now=now + 20) == 20
+
+    # A whole hemisphere is millions of cells, but only the tracked ones get looked at
+    assert index.coverage_age(0.0, -180.0, 90.0, 180.0, now=now) == math.inf
+    hemisphere = index.stale_bounds(0.0, -180.0, 90.0, 180.0, max_age=10, now=now)
+    assert hemisphere == pytest.approx((0.0, -180.0, 90.0, 180.0))
+
+
+def test_spatial_index_sweep():
+    index = SpatialIndex(expiry=60.0, sweep_interval=30.0)
+    index.ingest([{"hex": "aaaaaa", "lat": 50.05, "lon": 0.05}], 50.0, 0.0, 20.0, now=1000.0)
+    assert len(index) == 1 and index.coverage
+
+    # Nobody looked there again, but the next ingest anywhere past the sweep interval still clears it out
+    index.ingest([{"hex": "bbbbbb", "lat": -30.05, "lon": 150.05}], now=1100.0)
+    assert list(index.aircraft) == ["bbbbbb"]
+    assert not index.coverage and (500, 0) not in index.cells
+
+
+def test_query_planner():
+    index = SpatialIndex()
+    planner = QueryPlanner(index, slot_cost=100, max_circles=6)
+
+    # Nothing seen yet, so a squarish box goes out as a single circle at the default density
+    square = planner.plan(50.0, -1.0, 51.0, 0.5)
+    assert len(square.circles) == 1 and not square.estimated
+
+    # A long thin box over a busy patch of sky is cheaper to cover in pieces than with one huge circle
+    index.ingest([{"hex": f"{i:06x}", "lat": 50.05, "lon": -2.0 + i * 0.001} for i in range(2000)],
+                 50.0, -1.0, 60.0)
+    thin = planner.plan(50.0, -4.0, 50.3, 2.0)
+    assert thin.estimated and len(thin.circles) > 1
+    assert thin.rows == 1
+    assert thin.headers()["X-Query-Plan"] == f"1x{thin.cols}"
+
+    # Nothing under the upstream cap would cover Europe, so it gets as much as capped circles can reach and no more
+    europe = planner.plan(35.0, -10.0, 70.0, 40.0)
+    assert europe.clamped and len(europe.circles) == 6
+    assert all(radius <= MAX_RADIUS_NM for _, _, radius in europe.circles)
+
+    # Cells along the antimeridian and the poles still give a box (and a circle) on the globe
+    edge = index.stale_bounds(80.0, 170.0, 90.0, 180.0, max_age=0)
+    assert edge[2] == 90.0 and edge[3] == 180.0
+    planner.plan(*edge)
+
+
+def test_aggregate():
+    records = [{"hex": "a", "lat": 51.50, "lon": -0.10}, {"hex": "b", "lat": 51.52, "lon": -0.12},
+               {"hex": "c", "lat": 51.51, "lon": -0.11}, {"hex": "d", "lat": 40.0, "lon": 10.0}]
+
+    grouped = sorted(clusters(records, zoom=4), key=lambda c: -c["count"])
+    assert [c["count"] for c in grouped] == [3, 1]
+    assert grouped[0]["hex"] == "c"
+    assert grouped[0]["lat"] == pytest.approx(51.51)
+
+    counts = density_grid(records, 30.0, -20.0, 60.0, 20.0, 3, 4)
+    assert counts.shape == (3, 4)
+    assert counts.sum() == 4
+    assert counts[2, 1] == 3
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_radius_zoomed_out(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {"ac": []}
+    mock_get.return_value = mock_response
+
+    async with get_client() as ac:
+        europe = await ac.get("/radius", params={"sw_lat": 35.0, "sw_lon": -10.0, "ne_lat": 70.0, "ne_lon": 40.0})
+        calls = mock_get.call_count
+        radii = [float(circle.split(",")[2]) for circle in europe.headers["X-Query-Circles"].split(";")]
+        assert europe.headers["X-Query-Plan"].endswith("(clamped)")
+        assert max(radii) <= MAX_RADIUS_NM
+
+        # Capped circles only vouch for what they reach, so somewhere they missed still goes upstream
+        paris = await ac.get("/radius", params={"sw_lat": 48.8, "sw_lon": 2.3, "ne_lat": 48.9, "ne_lon": 2.4})
+        assert paris.status_code == 200
+        assert mock_get.call_count > calls
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_radius_aggregated(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = POINT
+    mock_get.return_value = mock_response
+
+    async with get_client() as ac:
+        params = {"sw_lat": 43.2, "sw_lon": 29.55, "ne_lat": 43.3, "ne_lon": 29.7}
+        points = await ac.get("/radius", params=params)
+        clustered = await ac.get("/radius", params={**params, "zoom": 3})
+        grid = await ac.get("/radius", params={**params, "zoom": 3, "aggregate": "grid", "grid": 4})
+        invalid = await ac.get("/radius", params={**params, "aggregate": "heatmap"})
+        wide_params = {"sw_lat": 40, "sw_lon": 25, "ne_lat": 55, "ne_lon": 40}
+        wide = await ac.get("/radius", params=wide_params)
+        inferred = await ac.get("/radius", params={**wide_params, "aggregate": "clusters"})
+
+        assert "ac" in points.json()
+        # Only summarised when asked for, a wide viewport on its own still gets every aircraft
+        assert [a["hex"] for a in wide.json()["ac"]] == [points.json()["ac"][0]["hex"]]
+        assert inferred.json()["zoom"] == 4 and inferred.json()["clusters"][0]["count"] == 1
+        assert clustered.json()["clusters"][0]["count"] == 1
+        assert clustered.json()["clusters"][0]["hex"] == points.json()["ac"][0]["hex"]
+        assert sum(map(sum, grid.json()["grid"]["counts"])) == 1
+        assert invalid.status_code == 400
+
+
 @pytest.mark.asyncio
 @patch("backend.adsb.main.adsb_request")
 async def test_radius_failure(mock_get):
@@ -56,6 +298,251 @@ async def test_radius_failure(mock_get):
         assert response.status_code == 503
 
 
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_radius_coalesced(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = POINT
+
+    async def slow_request(url):
+        await asyncio.sleep(0.1)
+        return mock_response
+    mock_get.side_effect = slow_request
+
+    async with get_client() as ac:
+        # The narrower viewport lands while the wider one is still waiting on upstream
+        wide = asyncio.create_task(ac.get("/radius", params={
+            "sw_lat": 43.15, "sw_lon": 29.5, "ne_lat": 43.35, "ne_lon": 29.8
+        }))
+        await asyncio.sleep(0.02)
+        narrow = ac.get("/radius", params={"sw_lat": 43.24, "sw_lon": 29.6, "ne_lat": 43.28, "ne_lon": 29.66})
+        responses = await asyncio.gather(wide, narrow)
+
+        assert all(response.status_code == 200 for response in responses)
+        assert all(len(response.json()["ac"]) == 1 for response in responses)
+        assert mock_get.call_count == 1
+
+        # Ingested in bulk on the way through, so /hex doesn't need another upstream call
+        assert "45211e" in hex_cache
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_radius_columnar(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = POINT
+    mock_get.return_value = mock_response
+
+    async with get_client() as ac:
+        params = {"sw_lat": 43.2, "sw_lon": 29.55, "ne_lat": 43.3, "ne_lon": 29.7}
+        expected = (await ac.get("/radius", params=params)).json()["ac"]
+
+        response = await ac.get("/radius", params=params, headers={"Accept": columnar.MEDIA_TYPE})
+        assert response.headers["Content-Type"] == columnar.MEDIA_TYPE
+
+        decoded = columnar.decode(response.content)
+        assert decoded[0]["hex"] == expected[0]["hex"]
+        assert decoded[0]["lat"] == expected[0]["lat"]
+        assert decoded[0]["track"] == pytest.approx(expected[0]["track"])
+
+
+def test_normalise():
+    aircraft = [
+        {"hex": "aaaaaa", "lat": 51.5, "lon": -0.1, "track": 90.0, "flight": "BAW1 "},
+        {"hex": "bbbbbb", "calc_track": 180.0, "lastPosition": {"lat": 51.6, "lon": -0.2}},
+        {"hex": "cccccc", "lat": 52.9, "lon": -0.1, "track": 10.0},
+        {"hex": "dddddd", "track": 10.0},
+        {"lat": 51.5, "lon": -0.1, "track": 10.0},
+    ]
+    records, motion, malformed = normalise(aircraft, bbox=(51.0, -1.0, 52.0, 1.0))
+
+    assert malformed == 2
+    assert [r["hex"] for r in records] == ["aaaaaa", "bbbbbb"]
+    assert records[1] == {"hex": "bbbbbb", "lat": 51.6, "lon": -0.2, "track": 180.0, "flight": "N/A"}
+
+    # On the ground is zero feet, and geometric altitude stands in when there's no barometric one
+    columns, _ = normalise_columns([{**aircraft[0], "alt_baro": "ground"}, {**aircraft[0], "alt_geom": 1200}], now=0)
+    assert columns["alt"].tolist() == [0.0, 1200.0]
+
+
+def test_extrapolate():
+    # Due east along the equator at 600 kt for a minute is 10 nm, i.e. 10 arc minutes of longitude
+    lat, lon = extrapolate([0.0, 10.0], [0.0, 20.0], [90.0, 0.0], [600.0, float("nan")], [100.0, 100.0], at=160.0)
+    assert lat[0] == pytest.approx(0.0, abs=1e-9)
+    assert lon[0] == pytest.approx(10 / 60, rel=1e-3)
+
+    # No ground speed, no movement
+    assert (lat[1], lon[1]) == pytest.approx((10.0, 20.0))
+
+    # Capped at the horizon
+    _, lon = extrapolate([0.0], [0.0], [90.0], [600.0], [100.0], at=10000.0, horizon=60.0)
+    assert lon[0] == pytest.approx(10 / 60, rel=1e-3)
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_radius_extrapolated(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = HEX_SINGLE
+    mock_get.return_value = mock_response
+
+    async with get_client() as ac:
+        await ac.get("/hex", params={"hex": "494112"})
+        aircraft = HEX_SINGLE["ac"][0]
+        bbox = {"sw_lat": aircraft["lat"] - 0.5, "sw_lon": aircraft["lon"] - 0.5,
+                "ne_lat": aircraft["lat"] + 0.5, "ne_lon": aircraft["lon"] + 0.5}
+
+        # Positions picked up from /hex sit in the index, so mark the (snapped) area covered rather than hitting
+        # upstream
+        _, snapped = quantize_bbox(*bbox.values())
+        row_min, col_min, row_max, col_max = spatial_index.cell_range(*snapped)
+        spatial_index.coverage.update({(row, col): time.time() for row in range(row_min, row_max + 1)
+                                       for col in range(col_min, col_max + 1)})
+
+        position_time = HEX_SINGLE["now"] / 1000 - aircraft["seen_pos"]
+        now = (await ac.get("/radius", params=bbox)).json()["ac"][0]
+        later = (await ac.get("/radius", params={**bbox, "at": position_time + 30})).json()["ac"][0]
+
+        expected_lat, expected_lon = extrapolate([aircraft["lat"]], [aircraft["lon"]], [aircraft["track"]],
+                                                 [aircraft["gs"]], [position_time], position_time + 30)
+        assert (now["lat"], now["lon"]) == (aircraft["lat"], aircraft["lon"])
+        assert (later["lat"], later["lon"]) == pytest.approx((expected_lat[0], expected_lon[0]))
+        assert mock_get.call_count == 1
+
+
+def test_columnar_roundtrip():
+    records = [
+        {"hex": "494112", "alt_baro": 43000, "gs": 414.6, "r": "CS-PHR"},
+        {"hex": "45211e", "alt_baro": "ground", "gs": None, "r": None},
+    ]
+    decoded = columnar.decode(columnar.encode(records, ["hex", "alt_baro", "gs", "r"]))
+    assert decoded == [
+        {"hex": "494112", "alt_baro": 43000, "gs": 414.6, "r": "CS-PHR"},
+        {"hex": "45211e", "alt_baro": "ground", "gs": None, "r": None},
+    ]
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_radius_delta(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = POINT
+    mock_get.return_value = mock_response
+    bbox = {"sw_lat": 43.2, "sw_lon": 29.55, "ne_lat": 43.3, "ne_lon": 29.7}
+
+    async with get_client() as ac:
+        first = (await ac.get("/radius", params={**bbox, "since": 0})).json()
+        assert first["full"] is True
+        assert len(first["ac"]) == 1
+
+        # Same aircraft a little further along
+        moved = copy.deepcopy(POINT)
+        moved["ac"][0]["lastPosition"]["lon"] += 0.01
+        mock_response.json.return_value = moved
+        spatial_index.clear()
+        radius_coalescer.clear()
+
+        second = (await ac.get("/radius", params={**bbox, "since": first["version"]})).json()
+        assert second["full"] is False
+        assert second["added"] == [] and second["removed"] == []
+        assert second["moved"][0]["lon"] == pytest.approx(29.646404)
+
+        # Too old (or never issued) versions just get everything again
+        resync = (await ac.get("/radius", params={**bbox, "since": 10 ** 6})).json()
+        assert resync["full"] is True
+
+
+def test_snapshot_versions_per_worker():
+    records = [{"hex": "aaaaaa", "lat": 50.0, "lon": 0.0, "track": 0.0, "flight": "N/A"}]
+    first, second = SnapshotStore(), SnapshotStore()
+    first.diff(records, 0)
+    second.diff(records, 0)
+
+    # A version handed out by one worker means nothing to another, so it resyncs rather than diffing
+    assert second.diff(records, first.diff(records, 0)["version"])["full"] is True
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_radius_stale_while_revalidate(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = POINT
+    mock_get.return_value = mock_response
+    bbox = {"sw_lat": 43.2, "sw_lon": 29.55, "ne_lat": 43.3, "ne_lon": 29.7}
+
+    async with get_client() as ac:
+        await ac.get("/radius", params=bbox)
+
+        # Twenty seconds later, with a long queue for upstream slots
+        for cell in spatial_index.coverage:
+            spatial_index.coverage[cell] -= 20
+        radius_coalescer.clear()
+        backlog = MagicMock()
+        backlog.estimated_wait.return_value = 30.0
+
+        with patch("backend.adsb.main.upstream.bucket", return_value=backlog):
+            response = await ac.get("/radius", params=bbox)
+
+        assert response.status_code == 200
+        assert len(response.json()["ac"]) == 1
+        assert int(response.headers["Age"]) >= 20
+
+        # The refresh goes out in the background instead
+        await asyncio.sleep(0.05)
+        assert mock_get.call_count == 2
+        assert "Age" not in (await ac.get("/radius", params=bbox)).headers
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_poller_refreshes_hottest_region(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = POINT
+    mock_get.return_value = mock_response
+
+    busy = (43.2, 29.55, 43.3, 29.7)
+    quiet = (51.4, -0.5, 51.5, -0.4)
+    poller.record(*busy)
+    poller.record(*busy)
+    poller.record(*quiet)
+
+    assert poller.next_region() == busy
+
+    # Once refreshed the busy region is fresh, so the quiet one gets the next slot
+    await poller.refresh(*poller.next_region())
+    assert poller.next_region() == quiet
+    assert len(spatial_index.query(*busy)) == 1
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_poller_clamped_region(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {"ac": []}
+    mock_get.return_value = mock_response
+
+    # A continent is never fully covered, but one refresh of it has to last a while all the same
+    europe = quantize_bbox(35.0, -10.0, 70.0, 40.0)[1]
+    busy = (43.2, 29.55, 43.3, 29.7)
+    for _ in range(3):
+        poller.record(*busy)
+    poller.record(*europe)
+
+    assert await poller.refresh_next() == busy
+    assert await poller.refresh_next() == europe
+    assert poller.next_region() is None
+
+    poller.regions[europe].clamped_at -= poller.clamped_min_age
+    assert poller.next_region() == europe
+
+
 @pytest.mark.asyncio
 @patch("backend.adsb.main.adsb_request")
 async def test_hex(mock_get):
@@ -79,7 +566,7 @@ async def test_hex_multiple(mock_get):
     mock_response.status_code = 200
     mock_response.json.return_value = HEX_MULTIPLE
     mock_get.return_value = mock_response
-    hex_ids = "494112,45211e"
+    hex_ids = "407446,4401d4"
 
     async with get_client() as ac:
         response = await ac.get("/hex", params={"hex": hex_ids})
@@ -88,6 +575,384 @@ async def test_hex_multiple(mock_get):
         assert len(data) == 2
 
 
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_hex_field_freshness(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = HEX_SINGLE
+    mock_get.return_value = mock_response
+
+    # Ingested a minute ago: registry data is still good, kinematics are not
+    hex_cache.ingest(HEX_SINGLE["ac"], now=time.time() - 60)
+
+    async with get_client() as ac:
+        response = await ac.get("/hex", params={"hex": "494112", "fields": "r,t,desc"})
+        assert response.json()["desc"] == "EMBRAER EMB-505 Phenom 300"
+        assert mock_get.call_count == 0
+
+        response = await ac.get("/hex", params={"hex": "494112"})
+        assert response.json()["gs"] == 414.6
+        assert mock_get.call_count == 1
+
+        response = await ac.get("/hex", params={"hex": "494112", "fields": "squawk"})
+        assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_hex_out_of_coverage(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {"ac": []}
+    mock_get.return_value = mock_response
+
+    # Last heard from hours ago and upstream has since lost it: the airframe is still known, where it was isn't
+    hex_cache.ingest(HEX_SINGLE["ac"], now=time.time() - 3 * 3600)
+
+    async with get_client() as ac:
+        response = await ac.get("/hex", params={"hex": "494112"})
+        assert response.status_code == 200
+        assert response.json()["desc"] == "EMBRAER EMB-505 Phenom 300"
+        assert response.json()["gs"] is None and response.json()["alt_baro"] is None
+        assert response.json()["seen"] is None
+
+    # Past the static ttl as well there's nothing left worth sending
+    hex_cache.ingest(HEX_SINGLE["ac"], now=time.time() - 2 * 86400)
+    assert hex_cache.peek("494112") is None
+
+
+def history_columns(hexes, lat, lon, position_time):
+    return {"hex": np.array(hexes, dtype=object), "flight": np.array(["TEST"] * len(hexes), dtype=object),
+            "lat": np.array(lat, dtype=float), "lon": np.array(lon, dtype=float),
+            "alt": np.full(len(hexes), 30000.0), "track": np.zeros(len(hexes)), "gs": np.full(len(hexes), 400.0),
+            "position_time": np.array(position_time, dtype=float)}
+
+
+def test_history_store(tmp_path):
+    store = HistoryStore(str(tmp_path), partition_seconds=3600, flush_interval=3600, lookback=60)
+    start = 1_700_000_000.0
+
+    store.append(history_columns(["a", "b"], [51.0, 40.0], [0.0, 10.0], [start, start]), now=start)
+    # Same fix for "a" again, which isn't stored twice, and "a" leaving the box later on
+    store.append(history_columns(["a"], [51.0], [0.0], [start]), now=start + 10)
+    store.flush(now=start + 10)
+    store.append(history_columns(["a"], [51.0], [3.0], [start + 4000]), now=start + 4000)
+    store.flush(now=start + 4000)
+
+    # One chunk in each hourly partition
+    assert sorted(os.listdir(tmp_path)) == [str(int(start // 3600 * 3600)), str(int((start + 4000) // 3600 * 3600))]
+
+    rows = store.between(50.0, -1.0, 52.0, 4.0, start - 1, start + 5000)
+    assert rows["hex"].tolist() == ["a", "a"]
+    assert rows["lon"].tolist() == [0.0, 3.0]
+
+    assert store.at(50.0, -1.0, 52.0, 1.0, start + 30)["hex"].tolist() == ["a"]
+    assert len(store.at(50.0, -1.0, 52.0, 1.0, start + 4030)["hex"]) == 0  # flown out of the box by then
+    assert len(store.at(50.0, -1.0, 52.0, 1.0, start + 3000)["hex"]) == 0  # nothing heard within the lookback
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_history(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = POINT
+    mock_get.return_value = mock_response
+
+    async with get_client() as ac:
+        params = {"sw_lat": 43.2, "sw_lon": 29.55, "ne_lat": 43.3, "ne_lon": 29.7}
+        live = (await ac.get("/radius", params=params)).json()["ac"]
+
+        # Everything the radius query saw went into the history store on the way through
+        history = await ac.get("/history", params={**params, "start": 0, "end": time.time() + 60})
+        assert [a["hex"] for a in history.json()["ac"]] == [a["hex"] for a in live]
+
+        at = await ac.get("/history", params={**params, "at": history.json()["ac"][0]["position_time"] + 1})
+        assert at.json()["ac"][0]["hex"] == live[0]["hex"]
+
+        # Over the limit, either end of the window can be kept
+        adsb_main.normalise_aircraft({"ac": [{**POINT["ac"][0], "seen_pos": 0}], "now": POINT["now"] + 10000})
+        window = {**params, "start": 0, "end": time.time() + 60, "limit": 1}
+        oldest = (await ac.get("/history", params=window)).json()
+        newest = (await ac.get("/history", params={**window, "newest": "true"})).json()
+        assert oldest["truncated"] and newest["truncated"]
+        assert newest["ac"][0]["position_time"] > oldest["ac"][0]["position_time"]
+
+        assert (await ac.get("/history", params=params)).status_code == 400
+
+
+def test_registry(tmp_path):
+    dump = tmp_path / "aircraft.csv"
+    dump.write_text("494112;CS-PHF;E55P;0000;EMBRAER EMB-505 Phenom 300;;\n"
+                    "43c6f2;ZZ336;A332;1000;AIRBUS A-330 Voyager;;\n"
+                    "~123456;;;;;;\n")
+    path = str(tmp_path / "registry.bin")
+    assert build(read_dump(str(dump)), path) == 2
+
+    registry = AircraftRegistry(path)
+    assert len(registry) == 2
+    assert registry.lookup("494112") == {"r": "CS-PHF", "t": "E55P", "desc": "EMBRAER EMB-505 Phenom 300",
+                                         "dbFlags": 0}
+    assert registry.lookup("43c6f2")["dbFlags"] == 1
+    assert registry.lookup("000001") is None
+    assert registry.lookup("~123456") is None
+    registry.close()
+
+    # Nothing built yet is the same as knowing nothing
+    assert AircraftRegistry(str(tmp_path / "missing.bin")).lookup("494112") is None
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_hex_registry(mock_get, tmp_path, monkeypatch):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = HEX_SINGLE
+    mock_get.return_value = mock_response
+
+    path = str(tmp_path / "registry.bin")
+    build([(0x494112, {"r": "CS-PHF", "t": "E55P", "desc": "EMBRAER EMB-505 Phenom 300", "dbFlags": 0})], path)
+    monkeypatch.setattr(adsb_main, "registry", AircraftRegistry(path))
+
+    async with get_client() as ac:
+        # Static fields come straight from the registry
+        response = await ac.get("/hex", params={"hex": "494112", "fields": "r,t,desc"})
+        assert response.json() == {"r": "CS-PHF", "t": "E55P", "desc": "EMBRAER EMB-505 Phenom 300"}
+        assert mock_get.call_count == 0
+
+        # Upstream is still needed for the live ones
+        response = await ac.get("/hex", params={"hex": "494112", "fields": "r,gs"})
+        assert response.json() == {"r": "CS-PHF", "gs": 414.6}
+        assert mock_get.call_count == 1
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_hex_image_cached(mock_get):
+    aircraft_response = MagicMock()
+    aircraft_response.status_code = 200
+    aircraft_response.json.return_value = HEX_SINGLE
+
+    # airport-data.com answers with an empty list for airframes it has no photo of
+    image_response = MagicMock()
+    image_response.status_code = 200
+    image_response.json.return_value = {"status": 404, "data": []}
+
+    mock_get.side_effect = lambda url: image_response if "airport-data.com" in url else aircraft_response
+
+    async with get_client() as ac:
+        for _ in range(2):
+            response = await ac.get("/hex", params={"hex": "494112", "image": "true"})
+            assert response.json()["image"] is None
+
+    image_calls = [call for call in mock_get.call_args_list if "airport-data.com" in call.args[0]]
+    assert len(image_calls) == 1
+
+    # Negative entry is on disk, so a fresh cache over the same file still knows about it
+    reopened = ThumbnailCache(thumbnail_cache.path)
+    assert "494112" in reopened
+    reopened.close()
+
+
+def test_thumbnail_cache_shared(tmp_path):
+    # Two workers over the same file keep it to one maxsize between them, oldest access going first
+    first = ThumbnailCache(str(tmp_path / "thumbnails.sqlite3"), maxsize=2)
+    second = ThumbnailCache(first.path, maxsize=2)
+    now = time.time()
+    first.put("aaaaaa", "a.jpg", now=now - 3)
+    second.put("bbbbbb", "b.jpg", now=now - 2)
+    first.put("cccccc", None, now=now - 1)
+
+    assert len(first) == len(second) == 2
+    assert "aaaaaa" not in second
+    assert first.get("bbbbbb") == "b.jpg"
+    first.close()
+    second.close()
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_thumbnail_prefetch_small_views(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = POINT
+    mock_get.return_value = mock_response
+    params = {"sw_lat": 43.2, "sw_lon": 29.55, "ne_lat": 43.3, "ne_lon": 29.7}
+
+    # Busier than the limit, so nothing is queued
+    async with get_client() as ac:
+        with patch.object(adsb_main, "THUMBNAIL_PREFETCH_MAX_AIRCRAFT", 0):
+            await ac.get("/radius", params=params)
+        assert not thumbnail_prefetcher.pending
+
+        await ac.get("/radius", params=params)
+        assert list(thumbnail_prefetcher.pending) == [POINT["ac"][0]["hex"]]
+
+
+@pytest.mark.asyncio
+async def test_thumbnail_prefetch_rate(tmp_path):
+    # Plenty of room in the host's own bucket, but the prefetcher still keeps to its lower rate
+    cache = ThumbnailCache(str(tmp_path / "thumbnails.sqlite3"))
+    fetch = AsyncMock()
+    prefetcher = ThumbnailPrefetcher(cache, fetch, lambda: TokenBucket(100.0), rate=1.0, interval=0.01)
+    prefetcher.enqueue(["aaaaaa", "bbbbbb", "cccccc"])
+
+    prefetcher.start()
+    await asyncio.sleep(0.3)
+    await prefetcher.stop()
+    cache.close()
+    assert [call.args[0] for call in fetch.call_args_list] == ["aaaaaa"]
+
+
+def test_trail_ring_buffer():
+    store = TrailStore(max_aircraft=2, points=3)
+    for t in range(5):
+        store.ingest(["aaaaaa"], [50.0 + t], [0.0], [1000.0], [float(t)])
+
+    # Only the newest three survive, and a repeat of the latest report isn't stored again
+    store.ingest(["aaaaaa"], [54.0], [0.0], [1000.0], [4.0])
+    assert [point[0] for point in store.trail("aaaaaa")] == [2.0, 3.0, 4.0]
+    assert [point[0] for point in store.trail("aaaaaa", n=2)] == [3.0, 4.0]
+
+    # Third aircraft takes the least recently updated row
+    store.ingest(["bbbbbb", "cccccc"], [1.0, 2.0], [1.0, 2.0], [float("nan")] * 2, [1.0, 1.0])
+    assert "aaaaaa" not in store
+    assert store.trail("cccccc") == [[1.0, 2.0, 2.0, None]]
+    assert store.stats()["tracked"] == 2
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_trail(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = HEX_MULTIPLE
+    mock_get.return_value = mock_response
+
+    async with get_client() as ac:
+        await ac.get("/hex", params={"hex": "407446,4401d4"})
+        response = await ac.get("/trail", params={"hex": "407446,4401d4,000000"})
+        assert response.status_code == 200
+        data = response.json()
+        assert set(data) == {"407446", "4401d4"}
+        assert data["407446"][0][1] == pytest.approx(HEX_MULTIPLE["ac"][0]["lat"], abs=1e-5)
+
+        response = await ac.get("/trail", params={"hex": "000000"})
+        assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_hex_batched(mock_get):
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = HEX_MULTIPLE
+    mock_get.return_value = mock_response
+
+    async with get_client() as ac:
+        first, second = await asyncio.gather(
+            ac.get("/hex", params={"hex": "407446"}),
+            ac.get("/hex", params={"hex": "4401d4"}),
+        )
+
+    assert first.status_code == 200 and second.status_code == 200
+    assert first.json()["r"] != second.json()["r"]
+    assert mock_get.call_count == 1
+    assert mock_get.call_args.args[0].endswith("/hex/407446,4401d4")
+
+
+@pytest.mark.asyncio
+async def test_hex_batcher_chunks():
+    calls = []
+
+    async def fetch(chunk):
+        calls.append(chunk)
+        return {h: {"hex": h} for h in chunk if h != "cccccc"}
+
+    batcher = HexBatcher(fetch, window=0.01, max_hexes=2)
+    results = await batcher.fetch(["aaaaaa", "bbbbbb", "cccccc"])
+
+    assert calls == [["aaaaaa", "bbbbbb"], ["cccccc"]]
+    assert set(results) == {"aaaaaa", "bbbbbb"}
+
+
+@pytest.mark.asyncio
+async def test_hex_batcher_cancelled_caller():
+    async def fetch(chunk):
+        await asyncio.sleep(0.02)
+        return {h: {"hex": h} for h in chunk}
+
+    # One client disconnecting leaves the other waiting on the same hex with its answer
+    batcher = HexBatcher(fetch, window=0.01)
+    gone = asyncio.create_task(batcher.fetch(["aaaaaa"]))
+    staying = asyncio.create_task(batcher.fetch(["aaaaaa"]))
+    await asyncio.sleep(0.015)
+    gone.cancel()
+
+    assert await staying == {"aaaaaa": {"hex": "aaaaaa"}}
+
+
+@pytest.mark.asyncio
+async def test_hex_batcher_shutdown():
+    async def fetch(chunk):
+        await asyncio.sleep(60)
+
+    # Chunks still running when the batcher is torn down cancel their waiters rather than leaving them hanging
+    batcher = HexBatcher(fetch, window=0.01)
+    waiter = asyncio.create_task(batcher.fetch(["aaaaaa"]))
+    await asyncio.sleep(0.02)
+    assert len(batcher.tasks) == 1
+
+    batcher.clear()
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(waiter, 1.0)
+    assert not batcher.tasks
+
+
+@pytest.mark.asyncio
+@patch("backend.adsb.main.adsb_request")
+async def test_hex_shared_cache(mock_get):
+    store = RedisHexStore(fakeredis.FakeRedis(), ttl=3600)
+
+    # Some other worker fetched it moments ago
+    other_worker = HexCache()
+    other_worker.ingest(HEX_SINGLE["ac"])
+    await store.put_many(other_worker.entries_for(["494112"]))
+
+    with patch("backend.adsb.main.shared_hexes", store):
+        async with get_client() as ac:
+            response = await ac.get("/hex", params={"hex": "494112"})
+
+    assert response.json()["desc"] == "EMBRAER EMB-505 Phenom 300"
+    assert mock_get.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_redis_bucket_shared_between_workers():
+    redis = fakeredis.FakeRedis()
+    first, second = RedisTokenBucket(redis, "slow.test", 5.0), RedisTokenBucket(redis, "slow.test", 5.0)
+
+    start = time.perf_counter()
+    await first.acquire()
+    await second.acquire()
+    assert time.perf_counter() - start >= 0.15
+
+
+@pytest.mark.asyncio
+async def test_redis_bucket_unreachable():
+    redis = MagicMock()
+    redis.set = AsyncMock(side_effect=RedisConnectionError("Connection refused"))
+    bucket = RedisTokenBucket(redis, "slow.test", 5.0)
+
+    # Still rate limited, just locally, and Redis isn't asked again on every call while it's down
+    start = time.perf_counter()
+    await bucket.acquire()
+    await bucket.acquire()
+    assert time.perf_counter() - start >= 0.15
+    assert redis.set.call_count == 1
+
+
 @pytest.mark.asyncio
 async def test_hex_missing():
     async with get_client() as ac:
@@ -106,4 +971,55 @@ async def test_hex_failure(mock_get):
 
     async with get_client() as ac:
         response = await ac.get("/hex", params={"hex": hex_id})
-        assert response.status_code == 503
\ No newline at end of file
+        assert response.status_code == 503
+
+
+@pytest.mark.asyncio
+async def test_upstream_buckets_per_host():
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, json={"ok": True}))
+    client = UpstreamClient({"slow.test": 2.0, "fast.test": 100.0}, transport=transport)
+
+    await client.get("https://slow.test/a")
+    slow = asyncio.create_task(client.get("https://slow.test/b"))
+
+    # The second slow.test call has to wait for a token, but that shouldn't hold up another host
+    start = time.perf_counter()
+    response = await client.get("https://fast.test/a")
+    assert response.json() == {"ok": True}
+    assert time.perf_counter() - start < 0.2
+
+    await slow
+    assert time.perf_counter() - start >= 0.4
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_record_and_replay(tmp_path):
+    responses = {
+        "/v2/point/43.26/29.63/10.0": POINT,
+        "/v2/hex/494112": HEX_SINGLE,
+    }
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, json=responses[request.url.path]))
+    path = str(tmp_path / "recording.jsonl.gz")
+
+    # Record through the real adsb_request, with upstream swapped for the mock transport
+    with patch("backend.adsb.main.upstream", UpstreamClient({}, default_rate=100.0, transport=transport)), \
+            patch("backend.adsb.main.recorder", Recorder(path, flush_every=1)):
+        for url in responses:
+            await adsb_main.adsb_request(f"https://api.airplanes.live{url}")
+        await adsb_main.upstream.close()
+
+    replayer = Replayer(path, speed=1000.0)
+
+    # Exactly what was recorded...
+    response = replayer.response("https://api.airplanes.live/v2/point/43.26/29.63/10.0")
+    assert response.status_code == 200
+    assert response.json()["ac"][0]["hex"] == "45211e"
+
+    # ...a smaller circle inside a recorded one...
+    response = replayer.response("https://api.airplanes.live/v2/point/43.261/29.636/1.0")
+    assert [a["hex"] for a in response.json()["ac"]] == ["45211e"]
+
+    # ...and hex lookups pieced together from every sighting in the recording
+    response = replayer.response("https://api.airplanes.live/v2/hex/45211e,494112,000000")
+    assert {a["hex"] for a in response.json()["ac"]} == {"45211e", "494112"}
@@ -1,20 +1,39 @@
 import io
 
 import pytest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
+from concurrent.futures import ThreadPoolExecutor
 from starlette.testclient import TestClient
 from PIL import Image
 
 import os
 import sys
+import time
+import tempfile
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 sys.path.insert(0, os.path.join(project_root, "backend", "mapping"))
+sys.path.insert(0, os.path.join(project_root, "backend", "common"))
+
+# Keep the tile store out of the working tree
+os.environ.setdefault("MAPPING_DATA_DIR", tempfile.mkdtemp())
 
 from backend.mapping.main import app
+from osm_stitcher import get_map, crop_map, get_tile, get_tile_bytes, tiles, fetcher, flights, mosaics
+from tilestore import TileStore
+from fetcher import TileFetcher, OutOfTime
 
 client = TestClient(app)
 
 
+# The tile store and failure cache are module-level, so would otherwise carry over between tests
+@pytest.fixture(autouse=True)
+def reset_tiles():
+    tiles.clear()
+    flights.clear()
+    mosaics.clear()
+    yield
+
+
 @pytest.fixture
 def mock_map():
     img = Image.new('RGB', (100, 100), color='red')
@@ -52,3 +71,163 @@ def test_validation(missing):
     response = client.get(missing)
     assert response.status_code == 422
 
+
+def png_bytes(color, size=(8, 8)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color=color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def test_tile_store(tmp_path):
+    path = str(tmp_path / "tiles.mbtiles")
+    store = TileStore(path, memory_bytes=250, disk_bytes=1000)
+
+    for x in range(8):
+        store.put((3, x, 0), bytes([x]) * 200)
+
+    # Both tiers stay within their byte limits, dropping the least recently used
+    stats = store.stats()
+    assert stats["memory"]["bytes"] <= 250 and stats["memory"]["entries"] == 1
+    assert stats["disk"]["bytes"] <= 1000 and stats["evictions"] > 0
+    assert store.get((3, 0, 0)) is None
+    assert store.get((3, 7, 0)) == bytes([7]) * 200
+    store.close()
+
+    # Still there after a restart, served from disk the first time and memory after that
+    store = TileStore(path, memory_bytes=250, disk_bytes=1000)
+    assert store.get((3, 6, 0)) == bytes([6]) * 200
+    assert store.get((3, 6, 0)) == bytes([6]) * 200
+    assert store.stats()["hits"] == {"memory": 1, "disk": 1}
+    store.close()
+
+
+def test_get_tile_cached():
+    with patch.object(fetcher.session, "get") as mock_get:
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.content = png_bytes("blue")
+
+        first = get_tile(1, 2, 3, API_KEY="key")
+        second = get_tile(1, 2, 3, API_KEY="key")
+
+        assert mock_get.call_count == 1
+        assert first.getpixel((0, 0)) == second.getpixel((0, 0)) == (0, 0, 255)
+        assert client.get("/stats").json()["tiles"]["hits"]["memory"] == 1
+
+
+def test_tile_bytes():
+    data = png_bytes("green")
+    with patch.object(fetcher.session, "get") as mock_get, patch("backend.mapping.main.OSM_API_KEY", "key"):
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.content = data
+
+        # Byte for byte what the tile server sent, both on the miss and from the store
+        assert client.get("/tile", params={"x": 1, "y": 1, "zoom": 2}).content == data
+        assert client.get("/tile", params={"x": 1, "y": 1, "zoom": 2}).content == data
+        assert mock_get.call_count == 1
+
+        mock_get.return_value.status_code = 500
+        assert client.get("/tile", params={"x": 2, "y": 1, "zoom": 2}).status_code == 502
+
+
+def test_fetcher_retries():
+    tile_fetcher = TileFetcher(retries=2, backoff=0.01)
+    busy = MagicMock(status_code=503)
+    ok = MagicMock(status_code=200, content=b"tile")
+
+    with patch.object(tile_fetcher.session, "get", side_effect=[busy, ok]) as mock_get:
+        assert tile_fetcher.fetch("https://tiles.test/1/2/3.png") == b"tile"
+        assert mock_get.call_count == 2
+
+    # A missing tile isn't worth asking for again, and an expired deadline stops it asking at all
+    with patch.object(tile_fetcher.session, "get", return_value=MagicMock(status_code=404)) as mock_get:
+        assert tile_fetcher.fetch("https://tiles.test/1/2/3.png") is None
+        assert mock_get.call_count == 1
+        with pytest.raises(OutOfTime):
+            tile_fetcher.fetch("https://tiles.test/1/2/3.png", deadline=time.monotonic() - 1)
+        assert mock_get.call_count == 1
+
+
+def test_get_map_composite():
+    for x in (0, 1):
+        for y in (0, 1):
+            tiles.put((1, x, y), png_bytes("blue" if x == 0 else "red", size=(4, 4)))
+
+    with patch.object(fetcher.session, "get") as mock_get:
+        img, (sw, ne) = get_map((-60.0, -170.0), (60.0, 170.0), zoom=1, tile_size=4, API_KEY="key")
+        assert mock_get.call_count == 0
+
+    assert img.size == (8, 8)
+    assert img.getpixel((0, 0)) == (0, 0, 255)
+    assert img.getpixel((7, 7)) == (255, 0, 0)
+    assert sw[1] == -180.0 and ne[1] == 180.0
+
+
+def test_tile_single_flight():
+    data = png_bytes("blue")
+
+    def slow_get(url, timeout=None):
+        time.sleep(0.1)
+        return MagicMock(status_code=200, content=data)
+
+    # Everyone missing the same tile at once shares the one download
+    shared = flights.stats()["shared"]
+    with patch.object(fetcher.session, "get", side_effect=slow_get) as mock_get:
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(lambda _: get_tile_bytes(5, 5, 5, API_KEY="key"), range(4)))
+        assert results == [data] * 4
+        assert mock_get.call_count == 1
+        assert flights.stats()["shared"] > shared
+
+    # A tile that just failed isn't asked for again straight away
+    negative_hits = flights.stats()["negative_hits"]
+    with patch.object(fetcher.session, "get", return_value=MagicMock(status_code=404)) as mock_get:
+        assert get_tile_bytes(6, 6, 6, API_KEY="key") is None
+        assert get_tile_bytes(6, 6, 6, API_KEY="key") is None
+        assert mock_get.call_count == 1
+        assert flights.stats()["negative_hits"] == negative_hits + 1
+
+    # Running out of time says nothing about the tile, so the next request still goes and gets it
+    with patch.object(fetcher.session, "get", return_value=MagicMock(status_code=200, content=data)) as mock_get:
+        assert get_tile_bytes(7, 7, 7, API_KEY="key", deadline=time.monotonic() - 1) is None
+        assert get_tile_bytes(7, 7, 7, API_KEY="key") == data
+        assert mock_get.call_count == 1
+
+
+def test_map_mosaic_cached():
+    for x in (0, 1):
+        for y in (0, 1):
+            tiles.put((1, x, y), png_bytes("blue", size=(4, 4)))
+
+    first, extent = get_map((-60.0, -170.0), (60.0, 170.0), zoom=1, tile_size=4, API_KEY="key")
+
+    # Overlapping viewport on the same tiles, served from the stitched mosaic without touching a tile
+    tiles.clear()
+    with patch.object(fetcher.session, "get") as mock_get:
+        second, _ = get_map((-50.0, -160.0), (50.0, 160.0), zoom=1, tile_size=4, API_KEY="key")
+        assert mock_get.call_count == 0
+    assert second is first
+    assert mosaics.stats()["hits"] == 1
+
+
+def test_crop_map():
+    img = Image.new('RGB', (512, 512), color='white')
+    extent = ((-85.0511287798066, -180.0), (85.0511287798066, 180.0))
+
+    # The western hemisphere's northern half is the top-left quarter of a zoom 0 tile
+    cropped, (sw, ne) = crop_map(img, extent, (0.0, -180.0), (85.0511287798066, 0.0))
+    assert cropped.size == (256, 256)
+    assert sw == pytest.approx((0.0, -180.0), abs=1e-9) and ne == pytest.approx((85.0511287798066, 0.0))
+
+    resized, _ = crop_map(img, extent, (0.0, -180.0), (85.0511287798066, 0.0), width=64)
+    assert resized.size == (64, 64)
+
+    # max_size shrinks the longest side but never enlarges a small crop
+    capped, _ = crop_map(img, extent, (-85.0511287798066, -180.0), (85.0511287798066, 180.0), max_size=128)
+    assert capped.size == (128, 128)
+    small, _ = crop_map(img, extent, (0.0, -180.0), (85.0511287798066, 0.0), max_size=1024)
+    assert small.size == (256, 256)
+
+    with patch("backend.mapping.main.get_map", return_value=(img, extent)):
+        response = client.get("/map", params={"sw_lat": 0.0, "sw_lon": -180.0, "ne_lat": 85.0511287798066,
+                                              "ne_lon": 0.0, "width": 100, "height": 50})
+        assert Image.open(io.BytesIO(response.content)).size == (100, 50)